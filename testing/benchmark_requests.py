@@ -0,0 +1,203 @@
+#
+# Measures the cycle time of HandleRequests against the number of requests
+# and the number of request workers, using an in-memory infoservice client
+# that adds a fixed latency to every call.
+#
+# Before timing, it checks that a cycle with several request workers
+# leaves the requests exactly as a cycle with one worker does.
+#
+#   python testing/benchmark_requests.py --requests 10,50,100 --workers 1,4,16 --latency 0.02
+#
+
+from optparse import OptionParser
+from ConfigParser import ConfigParser
+
+import copy
+import logging
+import os
+import sys
+import time
+
+(libpath,tail) = os.path.split(sys.path[0])
+sys.path.append(libpath)
+
+# the real modules are used where they are installed.
+import fake_infoservice
+
+from vc3infoservice.infoclient import InfoEntityMissingException
+from vc3master.metrics import MetricsRegistry
+from vc3master.cache import VC3ClientCache
+from vc3master.snapshot import RequestSnapshotService
+from vc3master.plugins.task.HandleRequests import HandleRequests
+
+
+class FakeEntity(object):
+    infoattributes = []
+
+    def __init__(self, **kwargs):
+        for a in self.infoattributes:
+            setattr(self, a, kwargs.get(a, None))
+
+class Request(FakeEntity):
+    infoattributes = ['name', 'state', 'state_reason', 'action', 'owner', 'cluster', 'project', 'allocations', 'environments', 'policy', 'expiration', 'headnode', 'statusraw', 'statusinfo', 'queuesconf', 'authconf']
+
+class Cluster(FakeEntity):
+    infoattributes = ['name', 'nodesets']
+
+class Nodeset(FakeEntity):
+    infoattributes = ['name', 'state', 'state_reason', 'node_number', 'app_type', 'app_role', 'app_host', 'app_sectoken', 'app_killorder', 'app_lingertime', 'environment']
+
+class Allocation(FakeEntity):
+    infoattributes = ['name', 'resource', 'accountname', 'sectype', 'pubtoken', 'privtoken']
+
+class Resource(FakeEntity):
+    infoattributes = ['name', 'accesstype', 'accessmethod', 'accessflavor', 'accesshost', 'accessport', 'sandboxdir', 'nodeinfo']
+
+class Nodeinfo(FakeEntity):
+    infoattributes = ['name', 'cores', 'memory_mb', 'storage_mb']
+
+class Environment(FakeEntity):
+    infoattributes = ['name', 'envmap', 'packagelist', 'required_os', 'builder_extra_args', 'command']
+
+
+class FakeClient(object):
+    '''
+    Stores entities in memory, sleeping latency seconds on every call.
+    '''
+    def __init__(self, latency):
+        self.latency  = latency
+        self.entities = {}
+        self.calls    = 0
+
+    def add(self, entity):
+        self.entities.setdefault(entity.__class__.__name__, {})[entity.name] = entity
+
+    def __getattr__(self, attr):
+        for prefix in ('get', 'list', 'store'):
+            if attr.startswith(prefix):
+                return lambda *args: self._call(prefix, attr[len(prefix):], args)
+        raise AttributeError(attr)
+
+    def _call(self, prefix, kind, args):
+        self.calls += 1
+        time.sleep(self.latency)
+        if prefix == 'list':
+            return [copy.deepcopy(e) for e in self.entities.get(kind[:-1], {}).values()]
+        if prefix == 'store':
+            self.add(copy.deepcopy(args[0]))
+            return
+        try:
+            return self.entities[kind][args[0]]
+        except KeyError:
+            raise InfoEntityMissingException("%s %s is missing" % (kind, args[0]))
+
+
+def populate(client, nrequests):
+    client.add(Nodeinfo(name = 'NODEINFO', cores = 1, memory_mb = 1024, storage_mb = 1024))
+    client.add(Environment(name = 'ENV', envmap = {}, packagelist = ['cctools'], builder_extra_args = []))
+    for i in range(nrequests):
+        name = 'REQUEST_%d' % i
+        client.add(Resource(name = 'RESOURCE_%d' % i, accesstype = 'batch', accessmethod = 'ssh', accessflavor = 'condor', accesshost = 'host%d.org' % i, accessport = 22, nodeinfo = 'NODEINFO'))
+        client.add(Allocation(name = 'ALLOCATION_%d' % i, resource = 'RESOURCE_%d' % i, accountname = 'user', sectype = 'ssh-rsa', pubtoken = 'pub', privtoken = 'priv'))
+        client.add(Nodeset(name = 'NODESET_%d' % i, node_number = 10, app_type = 'htcondor', app_role = 'worker-nodes', environment = 'ENV'))
+        client.add(Nodeset(name = 'headnode-for-' + name, state = 'running', app_host = '10.0.0.1', app_sectoken = 'secret'))
+        client.add(Cluster(name = 'CLUSTER_%d' % i, nodesets = ['NODESET_%d' % i]))
+
+        # a mix of requests that stay running, start running, are short of
+        # workers, and are being terminated.
+        (state, running, idle, action) = [('running', 10, 0, None), ('pending', 4, 6, None), ('running', 5, 2, None), ('running', 10, 0, 'terminate')][i % 4]
+        statusraw = { 'factory' : { 'NODESET_%d' % i : { 'ALLOCATION_%d' % i : { 'aggregated' : { 'running' : running, 'idle' : idle, 'error' : 0 }}}}}
+        client.add(Request(name = name, state = state, state_reason = 'Benchmark request.', action = action, cluster = 'CLUSTER_%d' % i, allocations = ['ALLOCATION_%d' % i], environments = [], headnode = 'headnode-for-' + name, statusraw = statusraw))
+
+
+class FakeMaster(object):
+    def __init__(self, client):
+        self.metrics     = MetricsRegistry()
+        self.clientcache = VC3ClientCache(client, self.metrics)
+        self.snapshots   = RequestSnapshotService(client, self.metrics, 0)
+
+class FakeTaskSet(object):
+    def __init__(self, master):
+        self.parent  = master
+        self.metrics = master.metrics
+        self.client  = master.clientcache.scope('benchmark')
+        self.polling_interval = 60
+
+
+def run_cycle(nrequests, workers, latency, prefetch, client = None):
+    if client is None:
+        client = FakeClient(latency)
+    populate(client, nrequests)
+
+    config = ConfigParser()
+    config.add_section('benchmark')
+    config.set('benchmark', 'request_workers', str(workers))
+
+    taskset = FakeTaskSet(FakeMaster(client))
+    plugin  = HandleRequests(taskset, config, 'benchmark')
+
+    start = time.time()
+    taskset.client.begin_cycle()
+    if prefetch:
+        taskset.client.prefetch(plugin.prefetch)
+    plugin.runtask()
+    taskset.client.end_cycle()
+    elapsed = time.time() - start
+
+    plugin.stop()
+    return (elapsed, client.calls)
+
+
+def stored_requests(client):
+    return dict([(name, dict([(a, getattr(r, a)) for a in Request.infoattributes])) for (name, r) in client.entities.get('Request', {}).items()])
+
+
+def check_workers(nrequests, workers):
+    '''
+    Runs a cycle with one request worker and one with workers, and compares
+    the requests they store.
+    '''
+    results = []
+    for w in (1, workers):
+        client = FakeClient(0)
+        run_cycle(nrequests, w, 0, False, client)
+        results.append(stored_requests(client))
+
+    (serial, concurrent) = results
+    different = [name for name in serial.keys() if serial[name] != concurrent.get(name, None)]
+    if different or len(serial) != len(concurrent):
+        raise Exception("%d requests differ with %d workers: %s" % (len(different), workers, ', '.join(sorted(different)[:5])))
+
+    states = {}
+    for r in serial.values():
+        states[r['state']] = states.get(r['state'], 0) + 1
+    print "%d workers: %d requests stored as with 1 worker (%s)" % (workers, len(serial), ', '.join(['%s %d' % x for x in sorted(states.items())]))
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig()
+    log = logging.getLogger()
+    log.setLevel(logging.WARNING)
+
+    parser = OptionParser(usage='%prog [OPTIONS]')
+    parser.add_option("--requests", dest="requests", default="10,50,100", help="Comma separated numbers of requests")
+    parser.add_option("--workers",  dest="workers",  default="1,4,16",    help="Comma separated numbers of request workers")
+    parser.add_option("--latency",  dest="latency",  default=0.02, type="float", help="Seconds added to every infoservice call")
+    parser.add_option("--prefetch", dest="prefetch", default=False, action="store_true", help="Prefetch entity listings as the taskset does")
+    (options, args) = parser.parse_args()
+
+    nrequests_list = [int(x) for x in options.requests.split(',')]
+    workers_list   = [int(x) for x in options.workers.split(',')]
+
+    for workers in workers_list:
+        if workers > 1:
+            check_workers(max(nrequests_list), workers)
+    print
+
+    print "%10s %10s %12s %12s" % ('requests', 'workers', 'cycle (s)', 'calls')
+    for nrequests in nrequests_list:
+        for workers in workers_list:
+            (elapsed, calls) = run_cycle(nrequests, workers, options.latency, options.prefetch)
+            print "%10d %10d %12.2f %12d" % (nrequests, workers, elapsed, calls)
+
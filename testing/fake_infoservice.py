@@ -0,0 +1,73 @@
+#
+# Stand-ins for the vc3infoservice client module and pluginmanager, enough
+# to import the task plugins where those packages are not installed.
+# Importing this file installs them, unless the real modules are available.
+#
+#   import fake_infoservice
+#
+
+import sys
+import types
+
+
+class InfoConnectionFailure(Exception):
+    pass
+
+
+class InfoEntityMissingException(Exception):
+    pass
+
+
+class Pairing(object):
+    pass
+
+
+class InfoClient(object):
+    '''
+    There is no infoservice behind the fake module: scripts using it pass
+    their own in-memory client (see benchmark_requests.py).
+    '''
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError('vc3infoservice is not installed, so there is no InfoClient to connect to an infoservice. Use an in-memory client such as the FakeClient of testing/benchmark_requests.py, or install vc3infoservice.')
+
+
+def getplugin(*args, **kwargs):
+    '''
+    Plugins cannot be loaded by name without pluginmanager; scripts using
+    the fake module construct the plugin classes themselves.
+    '''
+    raise RuntimeError('pluginmanager is not installed, so task plugins cannot be loaded by name. Construct the plugin class directly, as testing/benchmark_requests.py does, or install pluginmanager.')
+
+
+def install():
+    '''
+    Adds the fake modules to sys.modules, for the ones that cannot be
+    imported. Returns the names of the modules faked.
+    '''
+    faked = []
+
+    try:
+        import vc3infoservice.infoclient
+    except ImportError:
+        package = types.ModuleType('vc3infoservice')
+        package.__path__ = []
+        infoclient = types.ModuleType('vc3infoservice.infoclient')
+        for c in (InfoConnectionFailure, InfoEntityMissingException, Pairing, InfoClient):
+            setattr(infoclient, c.__name__, c)
+        package.infoclient = infoclient
+        sys.modules['vc3infoservice'] = package
+        sys.modules['vc3infoservice.infoclient'] = infoclient
+        faked.append('vc3infoservice.infoclient')
+
+    try:
+        import pluginmanager
+    except ImportError:
+        pluginmanager = types.ModuleType('pluginmanager')
+        pluginmanager.getplugin = getplugin
+        sys.modules['pluginmanager'] = pluginmanager
+        faked.append('pluginmanager')
+
+    return faked
+
+
+install()
@@ -0,0 +1,142 @@
+#
+# In-memory stand-in for a novaclient Client, enough for HandleHeadNodes,
+# NovaInventory and the warm pool. Running this file exercises NovaInventory
+# against it.
+#
+#   python testing/fake_nova.py
+#
+
+import logging
+import os
+import sys
+
+from datetime import datetime
+
+(libpath,tail) = os.path.split(sys.path[0])
+sys.path.append(libpath)
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeServer(object):
+    def __init__(self, manager, id, name, status = 'BUILD', networks = None, **kwargs):
+        self.manager  = manager
+        self.id       = id
+        self.name     = name
+        self.status   = status
+        self.networks = networks or {}
+        self.kwargs   = kwargs
+        self.updated  = datetime.utcnow()
+
+    def delete(self):
+        self.manager.delete(self)
+
+    def update(self, name = None):
+        self.manager.update(self, name = name)
+
+
+class FakeServerManager(object):
+    '''
+    Keeps servers in memory. Deleted servers are remembered, so that
+    changes-since listings report them as DELETED like Nova does.
+    '''
+    def __init__(self):
+        self.servers  = {}
+        self.deleted  = {}
+        self.next_id  = 0
+        self.listings = []
+
+    def create(self, name, **kwargs):
+        self.next_id += 1
+        server = FakeServer(self, str(self.next_id), name, **kwargs)
+        self.servers[server.id] = server
+        return server
+
+    def list(self, detailed = True, search_opts = None):
+        search_opts = search_opts or {}
+        self.listings.append(search_opts)
+        servers = self.servers.values()
+
+        since = search_opts.get('changes-since', None)
+        if since is not None:
+            since   = datetime.strptime(since, '%Y-%m-%dT%H:%M:%SZ')
+            servers = [s for s in servers if s.updated >= since]
+            servers.extend([s for s in self.deleted.values() if s.updated >= since])
+        return servers
+
+    def find(self, name):
+        for server in self.servers.values():
+            if server.name == name:
+                return server
+        raise NotFound(name)
+
+    def delete(self, server):
+        server = self.servers.pop(server.id)
+        server.status  = 'DELETED'
+        server.updated = datetime.utcnow()
+        self.deleted[server.id] = server
+
+    def update(self, server, name = None):
+        if name is not None:
+            server.name = name
+        server.updated = datetime.utcnow()
+
+    def boot_all(self, ip_prefix = '10.0.0.'):
+        '''
+        Makes all servers ACTIVE with an address, as if they finished booting.
+        '''
+        for server in self.servers.values():
+            if server.status == 'BUILD':
+                server.status   = 'ACTIVE'
+                server.networks = { 'private' : [ip_prefix + server.id, 'fe80::' + server.id] }
+                server.updated  = datetime.utcnow()
+
+
+class FakeNova(object):
+    def __init__(self):
+        self.servers = FakeServerManager()
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig()
+    log = logging.getLogger()
+    log.setLevel(logging.INFO)
+
+    from vc3master.metrics import MetricsRegistry
+    from vc3master.inventory import NovaInventory
+
+    nova      = FakeNova()
+    inventory = NovaInventory(nova, MetricsRegistry())
+
+    nova.servers.create(name = 'dev-a')
+    nova.servers.create(name = 'dev-b')
+    inventory.refresh()
+    assert inventory.status('dev-a') == 'BUILD'
+    assert inventory.ipv4('dev-a') is None
+
+    nova.servers.boot_all()
+    inventory.refresh()
+    assert nova.servers.listings[-1].has_key('changes-since')
+    assert inventory.status('dev-a') == 'ACTIVE'
+    assert inventory.ipv4('dev-a') == '10.0.0.1'
+
+    nova.servers.find('dev-b').delete()
+    inventory.refresh()
+    assert inventory.find('dev-b') is None
+    assert inventory.find('dev-a') is not None
+
+    # a name shared by two servers is never resolved to either of them.
+    from vc3master.inventory import DuplicateServerName
+    nova.servers.create(name = 'dev-a')
+    inventory.refresh()
+    try:
+        inventory.find('dev-a')
+        assert False, 'dev-a is not unique'
+    except DuplicateServerName:
+        pass
+
+    log.info('NovaInventory works against the fake nova: %d listings.', len(nova.servers.listings))
+
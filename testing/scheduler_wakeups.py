@@ -0,0 +1,96 @@
+#
+# Checks that an idle scheduler sleeps until its next deadline instead of
+# polling, and that concurrent triggers always keep the earliest deadline.
+#
+#   python testing/scheduler_wakeups.py
+#
+
+import os
+import random
+import sys
+import threading
+import time
+
+(libpath,tail) = os.path.split(sys.path[0])
+sys.path.append(libpath)
+
+from vc3master.scheduler import VC3Scheduler
+
+
+class StubTaskSet(object):
+    def __init__(self, section):
+        self.section = section
+        self.woken   = []
+
+    def wake(self, when = None):
+        self.woken.append((time.time(), when))
+
+    def stop(self):
+        pass
+
+    def join(self, timeout = None):
+        pass
+
+    def isAlive(self):
+        return False
+
+
+def check_idle():
+    scheduler = VC3Scheduler()
+    ts = StubTaskSet('idle')
+    scheduler.tasksets.append(ts)
+    scheduler.schedule(ts, time.time() + 2)
+    scheduler.start()
+
+    time.sleep(3)
+    scheduler.shutdown(1)
+
+    # one wakeup at the deadline, and possibly one for the shutdown.
+    assert len(ts.woken) == 1, ts.woken
+    assert scheduler.wakeups <= 2, scheduler.wakeups
+    (woken, when) = ts.woken[0]
+    assert 0 <= woken - when < 0.1, woken - when
+    print 'idle: %d wakeups in 3 seconds, woken %.3f seconds after the deadline' % (scheduler.wakeups, woken - when)
+
+
+def check_earlier_trigger():
+    scheduler = VC3Scheduler()
+    ts = StubTaskSet('trigger')
+    scheduler.tasksets.append(ts)
+    scheduler.schedule(ts, time.time() + 60)
+    scheduler.start()
+
+    time.sleep(0.2)
+    scheduler.trigger(ts, time.time() + 0.5)
+    time.sleep(1)
+    scheduler.shutdown(1)
+
+    assert len(ts.woken) == 1, ts.woken
+    print 'trigger: woken %.3f seconds after the earlier deadline' % (ts.woken[0][0] - ts.woken[0][1])
+
+
+def check_concurrent_triggers():
+    scheduler = VC3Scheduler()
+    ts = StubTaskSet('concurrent')
+    base = time.time() + 3600
+    whens = [base + random.random() * 100 for i in range(2000)]
+
+    def trigger(chunk):
+        for when in chunk:
+            scheduler.trigger(ts, when)
+
+    threads = [threading.Thread(target = trigger, args = (whens[i::8],)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert scheduler.next_deadline(ts) == min(whens), (scheduler.next_deadline(ts), min(whens))
+    print 'concurrent: earliest of %d triggers kept' % len(whens)
+
+
+if __name__ == '__main__':
+    check_idle()
+    check_earlier_trigger()
+    check_concurrent_triggers()
+    print 'ok'
@@ -0,0 +1,146 @@
+#
+# Runs the warm pool against the fake nova, with a stub playbook runner
+# that finishes every run on the next poll.
+#
+#   python testing/warmpool_cycle.py
+#
+
+import logging
+import os
+import sys
+
+(libpath,tail) = os.path.split(sys.path[0])
+sys.path.append(libpath)
+
+from fake_nova import FakeNova
+
+
+class StubJob(object):
+    def __init__(self, key, argv):
+        self.key        = key
+        self.argv       = argv
+        self.returncode = None
+
+
+class StubRunner(object):
+    '''
+    Records the submitted runs. poll() finishes them with status 0, or 2 for
+    the hosts in failing.
+    '''
+    def __init__(self):
+        self.jobs    = {}
+        self.runs    = []
+        self.failing = set()
+
+    def submit(self, key, priority, argv, cwd, env = None):
+        job = StubJob(key, argv)
+        self.jobs[key] = job
+        self.runs.append(argv)
+        return job
+
+    def poll(self):
+        for job in self.jobs.values():
+            if job.returncode is None:
+                host = job.argv[-1].rstrip(',')
+                job.returncode = (host in self.failing) and 2 or 0
+
+    def job(self, key):
+        return self.jobs.get(key, None)
+
+    def pop(self, key):
+        return self.jobs.pop(key, None)
+
+    def cancel(self, key):
+        self.jobs.pop(key, None)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig()
+    log = logging.getLogger()
+    log.setLevel(logging.INFO)
+
+    from vc3master.metrics import MetricsRegistry
+    from vc3master.inventory import NovaInventory
+    from vc3master.warmpool import WarmPool, parse_sizes
+
+    metrics   = MetricsRegistry()
+    nova      = FakeNova()
+    inventory = NovaInventory(nova, metrics)
+    runner    = StubRunner()
+
+    def command(app_type, host):
+        return (['ansible-playbook', 'login-%s-base.yaml' % app_type, '--inventory', host + ','], '.', None)
+
+    pool = WarmPool(nova, inventory, metrics, runner, parse_sizes('htcondor:2, spark:1'), 2, 'dev-', {}, lambda host: True, command)
+
+    def cycle():
+        inventory.refresh()
+        runner.poll()
+        pool.maintain()
+
+    # the budget allows only two of the three VMs asked for.
+    cycle()
+    assert len(nova.servers.servers) == 2
+
+    # boot, configure, ready.
+    nova.servers.boot_all()
+    cycle()
+    cycle()
+    ready = [name for (name, vm) in pool.vms.items() if vm['state'] == 'ready']
+    assert len(ready) == 2, pool.vms
+
+    app_type = pool.vms[ready[0]]['app_type']
+    server = pool.claim(app_type, 'dev-request-1')
+    assert server is not None and server.name == 'dev-request-1'
+    assert inventory.find('dev-request-1') is server
+    assert pool.claim('nosuchtype', 'dev-request-2') is None
+
+    # the claimed VM is replaced.
+    cycle()
+    assert len(pool.vms) == 2
+    assert len(nova.servers.servers) == 3
+
+    # a VM whose base playbook fails is deleted, and replaced.
+    nova.servers.boot_all()
+    cycle()
+    cycle()
+    assert pool.claim(app_type, 'dev-request-2') is not None
+    runner.failing.add('10.0.0.4')
+    cycle()
+    nova.servers.boot_all()
+    cycle()
+    cycle()
+    assert nova.servers.deleted.has_key('4')
+    cycle()
+    assert len(pool.vms) == 2
+
+    # a restarted master adopts the VMs of the pool.
+    other = WarmPool(nova, NovaInventory(nova, metrics), metrics, runner, parse_sizes('htcondor:2, spark:1'), 2, 'dev-', {}, lambda host: True, command)
+    other.inventory.refresh()
+    other.maintain()
+    assert sorted(other.vms.keys()) == sorted(pool.vms.keys())
+    assert other.counter == pool.counter
+
+    # a VM that never accepts ssh is deleted after boot_timeout, and one
+    # whose base playbook run is lost is deleted too.
+    nova = FakeNova()
+    inventory = NovaInventory(nova, metrics)
+    alive = set()
+    stuck = WarmPool(nova, inventory, metrics, runner, parse_sizes('htcondor:2'), 2, 'dev-', {}, lambda host: host in alive, command, boot_timeout = 0)
+    inventory.refresh()
+    stuck.maintain()
+    nova.servers.boot_all()
+    inventory.refresh()
+    alive.add(inventory.ipv4(sorted(stuck.vms.keys())[0]))
+    stuck.maintain()
+    assert len(nova.servers.deleted) == 1, nova.servers.deleted
+    configuring = [name for (name, vm) in stuck.vms.items() if vm['state'] == 'configuring']
+    assert len(configuring) == 1, stuck.vms
+    runner.jobs.pop(configuring[0])
+    inventory.refresh()
+    stuck.maintain()
+    assert not stuck.vms.has_key(configuring[0])
+    assert inventory.find(configuring[0]) is None
+
+    log.info('Warm pool works against the fake nova: %d playbook runs, %d servers booted.', len(runner.runs), nova.servers.next_id)
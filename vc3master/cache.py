@@ -0,0 +1,197 @@
+#
+# Cycle-scoped read-through cache in front of VC3ClientAPI.
+#
+
+import copy
+import logging
+import threading
+
+from vc3infoservice.infoclient import InfoEntityMissingException
+
+
+def entity_kind(methodname):
+    '''
+    getNodeset, listNodesets, storeNodeset, deleteNodeset -> 'nodeset'
+    '''
+    for prefix in ('get', 'list', 'store', 'delete'):
+        if methodname.startswith(prefix):
+            kind = methodname[len(prefix):].lower()
+            if prefix == 'list' and kind.endswith('s'):
+                kind = kind[:-1]
+            return kind
+    return None
+
+
+class VC3ClientCache(object):
+    '''
+    Owned by VC3Master. Hands out one CachedClient per taskset, so that each
+    taskset sees its own cycle, and propagates invalidations from a store in
+    any of them to all of them.
+    '''
+    def __init__(self, client, metrics):
+        self.log     = logging.getLogger()
+        self.client  = client
+        self.metrics = metrics
+        self.lock    = threading.Lock()
+        self.scopes  = []
+
+        # called as listener(kind, name) after every store/delete.
+        self.listeners = []
+
+        self.m_hits   = metrics.counter('vc3_client_cache_hits_total', 'Infoservice reads served from the cycle cache.')
+        self.m_misses = metrics.counter('vc3_client_cache_misses_total', 'Infoservice reads that went to the infoservice.')
+
+    def scope(self, name):
+        s = CachedClient(self, name)
+        with self.lock:
+            self.scopes.append(s)
+        return s
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def invalidate(self, kind, name = None):
+        with self.lock:
+            scopes    = list(self.scopes)
+            listeners = list(self.listeners)
+        for s in scopes:
+            s.invalidate(kind, name)
+        for listener in listeners:
+            listener(kind, name)
+
+
+class CachedClient(object):
+    '''
+    Behaves as a VC3ClientAPI. Results of get*/list* calls are memoized
+    until the next begin_cycle(). A store*/delete* drops the listing of that
+    kind of entity and the memoized get of the entity itself.
+
+    Every read returns its own copy of the memoized result, so that a caller
+    modifying an entity it does not store does not change what the other
+    callers in the cycle see.
+    '''
+    def __init__(self, cache, name):
+        self.log     = logging.getLogger()
+        self.cache   = cache
+        self.client  = cache.client
+        self.name    = name
+        self.lock    = threading.RLock()
+        self.entries = {}
+        self.indexes = {}
+        self.hits    = 0
+        self.misses  = 0
+
+    def begin_cycle(self):
+        with self.lock:
+            self.entries = {}
+            self.indexes = {}
+            self.hits    = 0
+            self.misses  = 0
+
+    def end_cycle(self):
+        with self.lock:
+            self.log.debug("Client cache for %s: %d hits, %d misses." % (self.name, self.hits, self.misses))
+            self.entries = {}
+            self.indexes = {}
+
+    def prefetch(self, kinds):
+        '''
+        Lists each kind of entity (e.g., 'Nodeset') with a single call and
+        indexes the result by name, so that get<Kind>(name) is answered from
+        memory for the rest of the cycle. Names not in the listing are still
+        looked up individually.
+        '''
+        for kind in kinds:
+            methodname = 'list%ss' % kind
+            lister = getattr(self.client, methodname, None)
+            if lister is None:
+                self.log.debug("Client has no %s, not prefetching %s." % (methodname, kind))
+                continue
+            try:
+                entities = self._read(methodname, lister, (), {})
+            except Exception, e:
+                self.log.warning("Could not prefetch %s entities. (%s)", kind, e)
+                continue
+
+            index = {}
+            for entity in (entities or []):
+                index[entity.name] = entity
+            with self.lock:
+                self.indexes[kind.lower()] = index
+            self.log.debug("Prefetched %d %s entities for %s." % (len(index), kind, self.name))
+
+    def invalidate(self, kind, name = None):
+        with self.lock:
+            for key in self.entries.keys():
+                (methodname, args, kwargs) = key
+                if entity_kind(methodname) != kind:
+                    continue
+                if methodname.startswith('list') or name is None or args[:1] == (name,):
+                    del self.entries[key]
+
+            if name is None:
+                self.indexes.pop(kind, None)
+            elif kind in self.indexes:
+                self.indexes[kind].pop(name, None)
+
+    def __getattr__(self, attr):
+        target = getattr(self.client, attr)
+        if not callable(target):
+            return target
+
+        if attr.startswith('get') or attr.startswith('list'):
+            return lambda *args, **kwargs: self._read(attr, target, args, kwargs)
+        if attr.startswith('store') or attr.startswith('delete'):
+            return lambda *args, **kwargs: self._write(attr, target, args, kwargs)
+        return target
+
+    def _read(self, attr, target, args, kwargs):
+        key  = (attr, args, tuple(sorted(kwargs.items())))
+        kind = entity_kind(attr)
+
+        try:
+            hash(key)
+        except TypeError:
+            # unhashable arguments, not cached.
+            return target(*args, **kwargs)
+
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None and attr.startswith('get') and len(args) == 1 and not kwargs:
+                index = self.indexes.get(kind, {})
+                if args[0] in index:
+                    entry = (False, index[args[0]])
+            if entry is not None:
+                self.hits += 1
+        if entry is not None:
+            self.cache.m_hits.inc(taskset = self.name, kind = kind)
+            (missing, value) = entry
+            if missing:
+                raise value
+            return copy.deepcopy(value)
+
+        with self.lock:
+            self.misses += 1
+        self.cache.m_misses.inc(taskset = self.name, kind = kind)
+
+        try:
+            value = target(*args, **kwargs)
+        except InfoEntityMissingException, e:
+            with self.lock:
+                self.entries[key] = (True, e)
+            raise
+
+        with self.lock:
+            self.entries[key] = (False, value)
+        return copy.deepcopy(value)
+
+    def _write(self, attr, target, args, kwargs):
+        try:
+            return target(*args, **kwargs)
+        finally:
+            name = None
+            if args:
+                name = getattr(args[0], 'name', args[0])
+            self.cache.invalidate(entity_kind(attr), name)
+
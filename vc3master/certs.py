@@ -0,0 +1,107 @@
+#
+# User certificates for pairing requests, issued off the task threads.
+#
+
+import Queue
+import logging
+import threading
+import time
+
+
+class CertificateSigner(object):
+    '''
+    Issues user certificates with SSCA.getusercert(cn) in workers
+    background threads. submit() queues a request and returns at once;
+    collect() returns the certificates issued since the last call, so that
+    they can be written back together. on_idle, if given, is called when the
+    last queued request is done. The threads are started with the first
+    request, and stop() ends them.
+
+    SSCA keeps its serial number and index in files, so unless the CA can
+    sign concurrently, workers should stay at 1.
+    '''
+    def __init__(self, ssca, metrics, workers = 1, on_idle = None):
+        self.log     = logging.getLogger()
+        self.ssca    = ssca
+        self.on_idle = on_idle
+        self.queue   = Queue.Queue()
+        self.lock    = threading.Lock()
+        self.pending = set()
+        self.done    = {}
+
+        self.m_issue   = metrics.histogram('vc3_pairing_issue_seconds', 'Time to issue a user certificate.')
+        self.m_pending = metrics.gauge('vc3_pairing_pending', 'Pairing certificates waiting to be issued.')
+        self.m_errors  = metrics.counter('vc3_pairing_errors_total', 'Pairing certificates that could not be issued.')
+
+        self.workers = workers
+        self.threads = []
+
+    def submit(self, code, cn):
+        '''
+        Queues the certificate of pairing code for cn, unless it is already
+        queued or issued and not collected yet.
+        '''
+        with self.lock:
+            if code in self.pending or self.done.has_key(code):
+                return False
+            self.pending.add(code)
+            self.m_pending.set(len(self.pending))
+            if not self.threads:
+                self._start()
+        self.queue.put((code, cn))
+        return True
+
+    def _start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target = self.work, name = 'pairing-signer-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self, timeout = None):
+        '''
+        Ends the worker threads once the requests already queued are done,
+        waiting at most timeout seconds for each.
+        '''
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        for t in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join(timeout)
+
+    def collect(self):
+        '''
+        code -> (certstr, keystr) of the certificates issued since the last
+        call. Requests that failed are dropped, and can be submitted again.
+        '''
+        with self.lock:
+            done = self.done
+            self.done = {}
+        return done
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (code, cn) = item
+            start = time.time()
+            try:
+                result = self.ssca.getusercert(cn)
+            except Exception, e:
+                self.log.warning("Could not issue certificate for pairing %s (%s)", code, e)
+                self.m_errors.inc()
+                result = None
+            self.m_issue.observe(time.time() - start)
+
+            with self.lock:
+                self.pending.discard(code)
+                self.m_pending.set(len(self.pending))
+                if result is not None:
+                    self.done[code] = result
+                idle = not self.pending
+
+            if idle and self.on_idle:
+                self.on_idle()
@@ -0,0 +1,85 @@
+#
+# Deadlines of time driven transitions, kept in a heap.
+#
+
+import calendar
+import heapq
+import threading
+import time
+
+
+def parse_utc(value, format = '%Y-%m-%dT%H:%M:%S'):
+    '''
+    Epoch time of value, a UTC time in format.
+    '''
+    return calendar.timegm(time.strptime(value, format))
+
+
+class DeadlineIndex(object):
+    '''
+    key -> deadline (epoch time). The deadlines are also kept in a min-heap,
+    so that next_deadline() is cheap; entries of keys whose deadline changed
+    or was removed are skipped when they reach the top of the heap.
+
+    deadline() keeps the value a deadline was parsed from, so that a value
+    that does not change is parsed only once.
+    '''
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.deadlines = {}
+        self.sources   = {}
+        self.heap      = []
+
+    def set(self, key, when):
+        with self.lock:
+            self._set(key, when)
+
+    def _set(self, key, when):
+        if when is None:
+            self.deadlines.pop(key, None)
+            return
+        if self.deadlines.get(key, None) == when:
+            return
+        self.deadlines[key] = when
+        heapq.heappush(self.heap, (when, key))
+
+    def deadline(self, key, value, parse = parse_utc):
+        '''
+        Deadline of key, parsed from value (None for no deadline).
+        '''
+        with self.lock:
+            if self.sources.has_key(key) and self.sources[key] == value:
+                return self.deadlines.get(key, None)
+            when = None
+            if value is not None:
+                when = parse(value)
+            self.sources[key] = value
+            self._set(key, when)
+            return when
+
+    def get(self, key):
+        with self.lock:
+            return self.deadlines.get(key, None)
+
+    def remove(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
+            self.sources.pop(key, None)
+
+    def keys(self):
+        with self.lock:
+            return list(set(self.deadlines.keys()) | set(self.sources.keys()))
+
+    def next_deadline(self, after = None):
+        '''
+        Earliest deadline later than after (default: now), or None.
+        '''
+        if after is None:
+            after = time.time()
+        with self.lock:
+            while self.heap:
+                (when, key) = self.heap[0]
+                if when > after and self.deadlines.get(key, None) == when:
+                    return when
+                heapq.heappop(self.heap)
+            return None
@@ -0,0 +1,137 @@
+#
+# Reverse index from entities to the requests that depend on them.
+#
+
+import hashlib
+import json
+import logging
+import threading
+
+from vc3master.tracking import entity_fields
+
+
+class DependencyIndex(object):
+    '''
+    Keeps, for every (kind, name) entity, the set of requests whose
+    processing reads it, and a digest of every entity as it was last seen.
+    Only the requests that depend on an entity that changed or disappeared
+    are marked dirty, so that the cost of a change is proportional to the
+    number of its dependents.
+
+    Writes through the client cache call invalidate() directly. Entities
+    changed by others are found by refresh(): it compares the names in the
+    listings, and the digests of new and invalidated entities; with
+    full = True it compares the digest of every entity.
+
+    A request without recorded dependencies is always dirty.
+    '''
+    def __init__(self, metrics):
+        self.log        = logging.getLogger()
+        self.lock       = threading.Lock()
+        self.dependents = {}
+        self.depends_on = {}
+        self.digests    = {}
+        self.stale      = set()
+        self.dirty      = set()
+
+        self.m_changed = metrics.counter('vc3_dependency_changes_total', 'Entities found changed between cycles, by kind.')
+        self.m_dirty   = metrics.counter('vc3_dependency_dirty_total', 'Requests marked dirty because an entity they depend on changed.')
+
+    def refresh(self, listings, full = False):
+        '''
+        listings is kind -> list of the current entities of that kind. Finds
+        the entities added or removed since the last refresh, and, if full,
+        the ones modified.
+        '''
+        current = {}
+        for (kind, entities) in listings.items():
+            for entity in entities or []:
+                current[(kind, entity.name)] = entity
+
+        with self.lock:
+            stale = self.stale
+            self.stale = set()
+            previous = self.digests
+
+        # only new and invalidated entities are digested, unless full.
+        digests = {}
+        changed = []
+        for (key, entity) in current.items():
+            if full or key in stale or not previous.has_key(key):
+                digests[key] = self.digest(entity)
+                if previous.get(key, None) != digests[key] and key not in stale:
+                    changed.append(key)
+            else:
+                digests[key] = previous[key]
+        changed.extend([key for key in previous.keys() if not current.has_key(key)])
+
+        with self.lock:
+            self.digests = digests
+            for key in changed:
+                self.m_changed.inc(kind = key[0])
+                self._mark_dirty(key)
+
+        if changed:
+            self.log.debug("%d entities changed since the last cycle." % len(changed))
+
+    def invalidate(self, kind, name = None):
+        '''
+        Marks dirty the dependents of an entity just written or deleted (of
+        all entities of kind if name is None). Registered as a listener of
+        the client cache.
+        '''
+        with self.lock:
+            if name is None:
+                keys = [key for key in self.dependents.keys() if key[0] == kind]
+            else:
+                keys = [(kind, name)]
+            for key in keys:
+                self.stale.add(key)
+                self._mark_dirty(key)
+
+    def _mark_dirty(self, key):
+        for request_name in self.dependents.get(key, ()):
+            if request_name not in self.dirty:
+                self.dirty.add(request_name)
+                self.m_dirty.inc()
+
+    def digest(self, entity):
+        return hashlib.sha1(json.dumps(entity_fields(entity), sort_keys = True, default = str)).hexdigest()
+
+    def set_dependencies(self, request_name, dependencies):
+        '''
+        Records the (kind, name) entities read by the last processing of
+        request_name, which is now clean.
+        '''
+        dependencies = set(dependencies)
+        with self.lock:
+            self._remove(request_name)
+            self.depends_on[request_name] = dependencies
+            for key in dependencies:
+                self.dependents.setdefault(key, set()).add(request_name)
+            self.dirty.discard(request_name)
+
+    def remove(self, request_name):
+        with self.lock:
+            self._remove(request_name)
+            self.dirty.discard(request_name)
+
+    def _remove(self, request_name):
+        for key in self.depends_on.pop(request_name, ()):
+            names = self.dependents.get(key, None)
+            if names is not None:
+                names.discard(request_name)
+                if not names:
+                    del self.dependents[key]
+
+    def is_dirty(self, request_name):
+        with self.lock:
+            return request_name in self.dirty or not self.depends_on.has_key(request_name)
+
+    def get_dependents(self, kind, name):
+        with self.lock:
+            return set(self.dependents.get((kind, name), ()))
+
+    def known_requests(self):
+        with self.lock:
+            return self.depends_on.keys()
@@ -0,0 +1,167 @@
+#
+# Per-cycle inventory of the OpenStack servers of the master.
+#
+
+import logging
+import re
+import time
+
+from datetime import datetime, timedelta
+
+
+class DuplicateServerName(Exception):
+    '''
+    More than one server has the name asked for (as nova's NoUniqueMatch).
+    '''
+    pass
+
+
+class NovaInventory(object):
+    '''
+    Lists the Nova servers once per cycle and indexes them by name, with
+    their status and IPv4 addresses already extracted. After the first
+    listing only the servers changed since the previous one are asked for
+    (changes-since), with a full listing every full_refresh_every cycles.
+
+    Lookups of a name shared by more than one server raise
+    DuplicateServerName, so that such a server is never taken for another.
+    '''
+    # overlap between consecutive changes-since listings, for clock skew.
+    skew = timedelta(seconds = 60)
+
+    def __init__(self, nova, metrics, full_refresh_every = 30):
+        self.log     = logging.getLogger()
+        self.nova    = nova
+        self.entries = {}
+        self.ids     = {}
+        self.loaded  = False
+        self.since   = None
+        self.full_refresh_every = full_refresh_every
+        self.refreshes = 0
+
+        self.m_listings = metrics.counter('vc3_nova_listings_total', 'Nova server listings, by kind.')
+        self.m_servers  = metrics.gauge('vc3_nova_servers', 'Servers in the Nova inventory.')
+
+    def refresh(self):
+        '''
+        Updates the inventory. On failure the previous inventory is kept.
+        '''
+        full = (not self.loaded) or (self.refreshes % self.full_refresh_every == 0)
+
+        search_opts = {}
+        if not full:
+            search_opts['changes-since'] = self.since
+
+        started = datetime.utcnow()
+        try:
+            servers = self.nova.servers.list(search_opts = search_opts)
+        except Exception, e:
+            self.log.warning("Could not list servers from openstack. (%s)", e)
+            return False
+
+        if full:
+            self.entries = {}
+            self.ids     = {}
+        for server in servers:
+            if server.status == 'DELETED':
+                self.forget(server)
+            else:
+                self.add(server)
+
+        self.loaded     = True
+        self.refreshes += 1
+        self.since      = (started - self.skew).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        self.m_listings.inc(kind = full and 'full' or 'changes-since')
+        self.m_servers.set(len(self.entries))
+        self.log.debug("Nova inventory has %d servers (%d listed)." % (len(self.entries), len(servers)))
+        return True
+
+    def add(self, server):
+        ids = self.ids.setdefault(server.name, set())
+        ids.add(server.id)
+        if len(ids) > 1:
+            self.log.warning("There are %d servers named %s, none of them will be used.", len(ids), server.name)
+        self.entries[server.name] = (server, server.status, self.parse_ipv4(server))
+
+    def forget(self, server):
+        '''
+        Drops a server listed as deleted.
+        '''
+        ids = self.ids.get(server.name, set())
+        ids.discard(server.id)
+        entry = self.entries.get(server.name, None)
+        if entry and entry[0].id == server.id:
+            # the other servers with its name are back in the next full listing.
+            self.entries.pop(server.name, None)
+        if not ids:
+            self.ids.pop(server.name, None)
+            self.entries.pop(server.name, None)
+
+    def remove(self, name):
+        self.entries.pop(name, None)
+        self.ids.pop(name, None)
+
+    def rename(self, name, new_name):
+        entry = self.entries.pop(name, None)
+        ids   = self.ids.pop(name, None)
+        if entry:
+            self.entries[new_name] = entry
+            self.ids[new_name]     = ids or set([entry[0].id])
+
+    def _entry(self, name):
+        if len(self.ids.get(name, ())) > 1:
+            raise DuplicateServerName("there are %d servers named %s" % (len(self.ids[name]), name))
+        return self.entries.get(name, None)
+
+    def names(self, prefix = ''):
+        return [name for name in self.entries.keys() if name.startswith(prefix)]
+
+    def parse_ipv4(self, server):
+        ips = []
+        networks = getattr(server, 'networks', None) or {}
+        for network in networks.keys():
+            for ip in networks[network]:
+                if re.match('\d+\.\d+\.\d+\.\d+$', ip):
+                    ips.append(ip)
+        return ips
+
+    def find(self, name):
+        '''
+        The server called name, or None. Before a first successful listing
+        this asks Nova directly.
+        '''
+        if not self.loaded:
+            try:
+                return self.nova.servers.find(name = name)
+            except Exception, e:
+                self.log.debug("Could not find server %s (%s)", name, e)
+                return None
+
+        entry = self._entry(name)
+        if entry:
+            return entry[0]
+        return None
+
+    def status(self, name):
+        entry = self._entry(name)
+        if entry:
+            return entry[1]
+        server = self.find(name)
+        return server and server.status
+
+    def ipv4(self, name):
+        '''
+        First IPv4 address of server name, or None.
+        '''
+        entry = self._entry(name)
+        if entry is None:
+            server = self.find(name)
+            if server is None:
+                return None
+            entry = (server, server.status, self.parse_ipv4(server))
+
+        if entry[2]:
+            return entry[2][0]
+        return None
+
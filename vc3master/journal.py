@@ -0,0 +1,188 @@
+#
+# Small persistent key/value store, kept as an append-only journal.
+#
+
+import errno
+import json
+import logging
+import os
+import threading
+
+
+class Journal(object):
+    '''
+    Keeps (table, key) -> value, where values are anything json can encode.
+    Every change is appended to path as one json line, and the whole file
+    is replayed when the journal is opened. When the journal holds more than
+    compact_factor times as many lines as live entries, it is rewritten with
+    only the live entries (to a temporary file, renamed over the old one).
+
+    Lines that cannot be read, like a last line cut short by a crash, are
+    ignored, and the journal is compacted when opened so that new lines are
+    not appended to them. With path None nothing is written, and the
+    journal is just an in-memory store.
+    '''
+    def __init__(self, path = None, compact_factor = 4, compact_min = 1000):
+        self.log   = logging.getLogger()
+        self.path  = path
+        self.lock  = threading.Lock()
+        self.state = {}
+        self.lines = 0
+        self.file  = None
+        self.compact_factor = compact_factor
+        self.compact_min    = compact_min
+
+        if self.path:
+            self.path = os.path.expanduser(self.path)
+            try:
+                os.makedirs(os.path.dirname(self.path), 0700)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            damaged = self._replay()
+            self.file = open(self.path, 'a')
+            if damaged:
+                self._compact()
+            self.log.debug("Journal %s has %d entries (%d lines)." % (self.path, len(self.state), self.lines))
+
+    def _replay(self):
+        '''
+        Returns True if some line could not be read, or the last one has no
+        newline.
+        '''
+        damaged = False
+        if not os.path.exists(self.path):
+            return damaged
+        with open(self.path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    damaged = True
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.log.warning("Ignoring bad line %d of journal %s", self.lines + 1, self.path)
+                    damaged = True
+                    continue
+                self.lines += 1
+                self._apply(record)
+        return damaged
+
+    def _apply(self, record):
+        key = (record['t'], record['k'])
+        if record.get('d', False):
+            self.state.pop(key, None)
+        else:
+            self.state[key] = record['v']
+
+    def _append(self, record):
+        self._apply(record)
+        if self.file is None:
+            return
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.lines += 1
+        if self.lines > max(self.compact_min, self.compact_factor * len(self.state)):
+            self._compact()
+
+    def get(self, table, key, default = None):
+        with self.lock:
+            return self.state.get((table, key), default)
+
+    def put(self, table, key, value):
+        with self.lock:
+            # unchanged values are not written again.
+            if self.state.get((table, key), self) == value:
+                return
+            self._append({ 't' : table, 'k' : key, 'v' : value })
+
+    def delete(self, table, key):
+        with self.lock:
+            if not self.state.has_key((table, key)):
+                return
+            self._append({ 't' : table, 'k' : key, 'd' : True })
+
+    def items(self, table):
+        with self.lock:
+            return [(k, v) for ((t, k), v) in self.state.items() if t == table]
+
+    def table(self, name):
+        return JournalTable(self, name)
+
+    def compact(self):
+        with self.lock:
+            if self.file is not None:
+                self._compact()
+
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for ((table, key), value) in self.state.items():
+                f.write(json.dumps({ 't' : table, 'k' : key, 'v' : value }) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.rename(tmp, self.path)
+        self.file  = open(self.path, 'a')
+        self.lines = len(self.state)
+        self.log.debug("Compacted journal %s to %d entries." % (self.path, self.lines))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class JournalTable(object):
+    '''
+    Dictionary-like view of one table of a journal. Assignments and pops are
+    written through to the journal.
+    '''
+    def __init__(self, journal, name):
+        self.journal = journal
+        self.name    = name
+
+    def get(self, key, default = None):
+        return self.journal.get(self.name, key, default)
+
+    def has_key(self, key):
+        return self.journal.get(self.name, key, self) is not self
+
+    __contains__ = has_key
+
+    def __getitem__(self, key):
+        value = self.journal.get(self.name, key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.journal.put(self.name, key, value)
+
+    def pop(self, key, *default):
+        value = self.journal.get(self.name, key, self)
+        if value is self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self.journal.delete(self.name, key)
+        return value
+
+    def setdefault(self, key, value):
+        current = self.journal.get(self.name, key, self)
+        if current is self:
+            self.journal.put(self.name, key, value)
+            return value
+        return current
+
+    def add(self, key):
+        self.journal.put(self.name, key, True)
+
+    def discard(self, key):
+        self.journal.delete(self.name, key)
+
+    def items(self):
+        return self.journal.items(self.name)
+
+    def keys(self):
+        return [k for (k, v) in self.items()]
@@ -0,0 +1,114 @@
+#
+# SSH key material for allocations, generated off the task threads.
+#
+
+import Queue
+import logging
+import threading
+import time
+
+from base64 import b64encode
+
+
+class KeyMaterialService(threading.Thread):
+    '''
+    Gets the ssh keys of principals from the credible keystore (which
+    generates them the first time a principal is asked for) in a background
+    thread, and keeps them in memory already base64 encoded.
+
+    get() never blocks: it returns None while the keys are being generated.
+    warm() queues principals that will be needed soon, so that their keys
+    are usually ready when they are asked for. Keys are only kept until the
+    caller has copied them: see forget() and retain().
+    '''
+    def __init__(self, ssh, metrics):
+        threading.Thread.__init__(self)
+        self.daemon  = True
+        self.log     = logging.getLogger()
+        self.ssh     = ssh
+        self.queue   = Queue.Queue()
+        self.lock    = threading.Lock()
+        self.keys    = {}
+        self.errors  = {}
+        self.pending = set()
+
+        self.m_generated = metrics.histogram('vc3_ssh_keys_seconds', 'Time to get ssh keys from the keystore.')
+        self.m_lookups   = metrics.counter('vc3_ssh_keys_lookups_total', 'ssh key lookups, by result (ready, pending).')
+        self.m_pending   = metrics.gauge('vc3_ssh_keys_pending', 'Principals waiting for their ssh keys.')
+
+    def warm(self, principals):
+        with self.lock:
+            for principal in principals:
+                self._enqueue(principal)
+
+    def _enqueue(self, principal):
+        if self.keys.has_key(principal) or principal in self.pending:
+            return
+        self.pending.add(principal)
+        self.m_pending.set(len(self.pending))
+        self.queue.put(principal)
+
+    def get(self, principal):
+        '''
+        (pub, priv), base64 encoded, or None if they are not ready yet.
+        Raises the error of the keystore if generating them failed.
+        '''
+        with self.lock:
+            error = self.errors.pop(principal, None)
+            if error is not None:
+                raise error
+
+            keys = self.keys.get(principal, None)
+            if keys is None:
+                self._enqueue(principal)
+                self.m_lookups.inc(result = 'pending')
+            else:
+                self.m_lookups.inc(result = 'ready')
+            return keys
+
+    def forget(self, principal):
+        with self.lock:
+            self.keys.pop(principal, None)
+            self.errors.pop(principal, None)
+
+    def retain(self, principals):
+        '''
+        Forgets the keys and errors of every principal not in principals.
+        '''
+        principals = set(principals)
+        with self.lock:
+            for principal in self.keys.keys():
+                if principal not in principals:
+                    self.keys.pop(principal)
+            for principal in self.errors.keys():
+                if principal not in principals:
+                    self.errors.pop(principal)
+
+    def run(self):
+        while True:
+            principal = self.queue.get()
+            if principal is None:
+                break
+
+            start = time.time()
+            try:
+                (pub, priv) = self.ssh.getkeys(principal)
+                keys  = (b64encode(pub), b64encode(priv))
+                error = None
+                self.log.debug("Got ssh keys for %s in %.2f seconds." % (principal, time.time() - start))
+            except Exception, e:
+                self.log.warning("Could not get ssh keys for %s (%s)", principal, e)
+                keys  = None
+                error = e
+            self.m_generated.observe(time.time() - start)
+
+            with self.lock:
+                self.pending.discard(principal)
+                self.m_pending.set(len(self.pending))
+                if keys:
+                    self.keys[principal] = keys
+                else:
+                    self.errors[principal] = error
+
+    def stop(self):
+        self.queue.put(None)
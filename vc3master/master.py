@@ -37,6 +37,12 @@ import pluginmanager as pm
 from vc3infoservice.infoclient import InfoClient
 from vc3client.client import VC3ClientAPI
 from vc3master.task import VC3TaskSet
+from vc3master.scheduler import VC3Scheduler
+from vc3master.metrics import MetricsRegistry, MetricsServer
+from vc3master.cache import VC3ClientCache
+from vc3master.snapshot import RequestSnapshotService
+from vc3master.sshmux import SSHControlPool
+from vc3master.keys import KeyMaterialService
 from credible.core import SSCA, SSHKeyManager
 
 class VC3Master(object):
@@ -52,6 +58,33 @@ class VC3Master(object):
         self.chainfile = os.path.expanduser(config.get('netcomm','chainfile'))
 
         self.client    = VC3ClientAPI(config)
+
+        self.metrics   = MetricsRegistry()
+        self.metrics_server = None
+        if config.has_option('master', 'metrics_port'):
+            metrics_host = '127.0.0.1'
+            if config.has_option('master', 'metrics_host'):
+                metrics_host = config.get('master', 'metrics_host')
+            self.metrics_server = MetricsServer(self.metrics, metrics_host, int(config.get('master', 'metrics_port')))
+
+        # each taskset gets its own cycle-scoped view of this cache.
+        self.clientcache = VC3ClientCache(self.client, self.metrics)
+
+        # single listing of requests shared by all plugins.
+        snapshot_max_age = 30
+        if config.has_option('master', 'request_snapshot_max_age'):
+            snapshot_max_age = int(config.get('master', 'request_snapshot_max_age'))
+        self.snapshots = RequestSnapshotService(self.client, self.metrics, snapshot_max_age)
+        self.clientcache.add_listener(self.snapshots.expire)
+
+        # persistent ssh connections shared by the headnode and allocation checks.
+        ssh_control_dir = None
+        if config.has_option('master', 'ssh_control_dir'):
+            ssh_control_dir = config.get('master', 'ssh_control_dir')
+        ssh_control_persist = 300
+        if config.has_option('master', 'ssh_control_persist'):
+            ssh_control_persist = int(config.get('master', 'ssh_control_persist'))
+        self.sshpool = SSHControlPool(self.metrics, ssh_control_dir, ssh_control_persist)
         
         #self.dynpluginname = config.get('dynamic','plugin')
         #self.dynpluginsection = "plugin-%s" % self.dynpluginname.lower() 
@@ -73,16 +106,26 @@ class VC3Master(object):
         self.ssca = SSCA( self.credconfig ) 
         self.ssh = SSHKeyManager(self.credconfig) 
 
+        # ssh keys are read or generated in the background, see HandleAllocations.
+        self.keys = KeyMaterialService(self.ssh, self.metrics)
+
         self.infoclient = InfoClient(config)
        
         self.taskconfig = ConfigParser()
         self.taskconfig.read(os.path.expanduser(self.config.get('master','taskconf')))
 
+        self.shutdown_timeout = 30
+        if self.config.has_option('master', 'shutdown_timeout'):
+            self.shutdown_timeout = int(self.config.get('master', 'shutdown_timeout'))
+
+        self.scheduler = VC3Scheduler()
+
         self.tasksets = []
         for tset in self.taskconfig.sections():
             self.log.debug("Handling taskset %s" % tset)
             ts = VC3TaskSet(self, self.taskconfig, tset)
             self.tasksets.append(ts)
+            self.scheduler.add(ts)
         self.log.debug('Tasksets loaded.')        
             
         self.log.debug('VC3Master class done.')
@@ -90,16 +133,23 @@ class VC3Master(object):
         
     def run(self):
         self.log.debug('Master running...')
+        if self.metrics_server:
+            self.metrics_server.start()
+        self.keys.start()
         for ts in self.tasksets:
             self.log.debug("Starting taskset thread %s" % ts.section)
             ts.start()
         self.log.debug("All TaskSet threads started...")
+        self.scheduler.start()
         
       
     def shutdown(self):
         self.log.debug("Got shutdown command...")
-        for ts in self.tasksets:
-            ts.join()
+        self.scheduler.shutdown(self.shutdown_timeout)
+        self.sshpool.close_all()
+        self.keys.stop()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
         self.log.debug("Done.")
 
 
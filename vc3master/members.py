@@ -0,0 +1,131 @@
+#
+# Resolution of project members to their user entities.
+#
+
+import hashlib
+import json
+import logging
+import threading
+
+
+class Membership(object):
+    '''
+    The members of a project, with the attributes of their users that the
+    plugins need. Validation of ssh keys is done at most once per member.
+    '''
+    attributes_kept = ['sshpubstring', 'identity_id']
+
+    def __init__(self, project, users, digest, validate_key = None):
+        self.project  = project.name
+        self.members  = list(project.members or [])
+        self.digest   = digest
+        self.validate_key = validate_key
+
+        # member -> { attribute -> value }, for the members that are users.
+        self.users    = {}
+        self.missing  = []
+        for member in self.members:
+            user = users.get(member, None)
+            if user is None:
+                self.missing.append(member)
+            else:
+                self.users[member] = dict([(a, getattr(user, a, None)) for a in self.attributes_kept])
+
+        self.valid_keys = {}
+        self.lock       = threading.Lock()
+
+    def attribute(self, attribute):
+        '''
+        member -> value of attribute, for the members that have it.
+        '''
+        return dict([(m, u[attribute]) for (m, u) in self.users.items() if u[attribute]])
+
+    def has_valid_key(self, member):
+        with self.lock:
+            if self.valid_keys.has_key(member):
+                return self.valid_keys[member]
+        # validated outside the lock; two threads may both validate a key.
+        key   = self.users[member]['sshpubstring']
+        valid = bool(key) and self.validate_key(key)
+        with self.lock:
+            self.valid_keys[member] = valid
+        return valid
+
+
+class ProjectMembership(object):
+    '''
+    Resolves the members of projects from one listUsers() per cycle (which
+    the cycle cache serves to every caller in the cycle), instead of one
+    getUser() per member and caller.
+
+    The Membership of a project is kept while neither its list of members
+    nor the attributes of those users change, so that work derived from it,
+    like validating keys, is not repeated every cycle.
+    '''
+    def __init__(self, client, metrics):
+        self.log         = logging.getLogger()
+        self.client      = client
+        self.memberships = {}
+        self.lock        = threading.Lock()
+        self.listing     = None
+        self.users       = {}
+
+        self.m_resolved = metrics.counter('vc3_project_memberships_total', 'Project membership resolutions, by result (reused, rebuilt).')
+
+    def index(self):
+        listing = self.client.listUsers() or []
+        # the cycle cache returns the same listing until the next cycle.
+        if listing is not self.listing:
+            self.users   = dict([(u.name, u) for u in listing])
+            self.listing = listing
+        return self.users
+
+    def resolve(self, project):
+        with self.lock:
+            users  = self.index()
+            digest = self.digest(project, users)
+
+            membership = self.memberships.get(project.name, None)
+            if membership and membership.digest == digest:
+                self.m_resolved.inc(result = 'reused')
+                return membership
+
+            membership = Membership(project, users, digest, self.client.validate_ssh_pub_key)
+            self.memberships[project.name] = membership
+        self.m_resolved.inc(result = 'rebuilt')
+        self.log.debug("Resolved %d members of project %s (%d missing)." % (len(membership.members), project.name, len(membership.missing)))
+        return membership
+
+    def for_request(self, request):
+        '''
+        Membership of the project of request, or None if it has no project.
+        Raises InfoEntityMissingException if the project does not exist.
+        '''
+        if not request.project:
+            return None
+        return self.resolve(self.client.getProject(request.project))
+
+    def digest(self, project, users):
+        state = []
+        for member in project.members or []:
+            user = users.get(member, None)
+            if user is None:
+                state.append([member, None])
+            else:
+                state.append([member] + [getattr(user, a, None) for a in Membership.attributes_kept])
+        return hashlib.sha1(json.dumps(state)).hexdigest()
+
+    def prune(self):
+        '''
+        Forgets the memberships of projects that are no longer listed.
+        '''
+        try:
+            names = set([p.name for p in self.client.listProjects() or []])
+        except Exception, e:
+            self.log.debug("Could not list projects to prune memberships (%s)", e)
+            return
+        with self.lock:
+            for name in self.memberships.keys():
+                if name not in names:
+                    self.memberships.pop(name)
+                    self.log.debug("Forgot membership of project %s." % name)
@@ -0,0 +1,194 @@
+#
+# In-process metrics, exported in the Prometheus text exposition format.
+#
+
+import BaseHTTPServer
+import logging
+import threading
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _labelkey(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labelkey, extra = None):
+    pairs = list(labelkey)
+    if extra:
+        pairs.extend(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(['%s="%s"' % (k, _escape(v)) for (k, v) in pairs]) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    '''
+    A named family of samples, one per distinct set of labels.
+    '''
+    kind = None
+
+    def __init__(self, name, help):
+        self.name    = name
+        self.help    = help
+        self.lock    = threading.Lock()
+        self.samples = {}
+
+    def get(self, **labels):
+        with self.lock:
+            return self.samples.get(_labelkey(labels), 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            for labelkey in sorted(self.samples.keys()):
+                lines.extend(self._render_sample(labelkey, self.samples[labelkey]))
+        return lines
+
+    def _render_sample(self, labelkey, value):
+        return ['%s%s %s' % (self.name, _format_labels(labelkey), _format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = _labelkey(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.samples[_labelkey(labels)] = value
+
+    def inc(self, amount = 1, **labels):
+        key = _labelkey(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets = DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = _labelkey(labels)
+        with self.lock:
+            sample = self.samples.get(key, None)
+            if sample is None:
+                sample = {'counts' : [0] * len(self.buckets), 'sum' : 0.0, 'count' : 0}
+                self.samples[key] = sample
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample['counts'][i] += 1
+            sample['sum']   += value
+            sample['count'] += 1
+
+    def get(self, **labels):
+        with self.lock:
+            sample = self.samples.get(_labelkey(labels), None)
+            if sample is None:
+                return (0, 0.0)
+            return (sample['count'], sample['sum'])
+
+    def _render_sample(self, labelkey, sample):
+        lines = []
+        for bound, count in zip(self.buckets, sample['counts']):
+            lines.append('%s_bucket%s %d' % (self.name, _format_labels(labelkey, [('le', _format_value(bound))]), count))
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(labelkey), _format_value(sample['sum'])))
+        lines.append('%s_count%s %d' % (self.name, _format_labels(labelkey), sample['count']))
+        return lines
+
+
+class MetricsRegistry(object):
+    '''
+    Holds all metrics of the master. Metrics are created on first use, and
+    asking again for the same name returns the same object.
+    '''
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.metrics = {}
+
+    def _get_or_create(self, cls, name, help, *args):
+        with self.lock:
+            metric = self.metrics.get(name, None)
+            if metric is None:
+                metric = cls(name, help, *args)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s already registered as a %s" % (name, metric.kind))
+            return metric
+
+    def counter(self, name, help):
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get_or_create(Gauge, name, help)
+
+    def histogram(self, name, help, buckets = DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics.keys())]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger().debug("metrics: " + format, *args)
+
+
+class MetricsServer(threading.Thread):
+    '''
+    Serves the registry at http://<host>:<port>/metrics from a daemon thread.
+    '''
+    def __init__(self, registry, host, port):
+        self.log = logging.getLogger()
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self.httpd.registry = registry
+        self.log.debug("Metrics endpoint listening on %s:%d" % (host, port))
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
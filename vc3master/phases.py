@@ -0,0 +1,93 @@
+#
+# Timing of the provisioning steps of headnodes.
+#
+
+import copy
+import logging
+import time
+
+# provisioning takes minutes, so the buckets go up to two hours.
+PHASE_BUCKETS = (5, 10, 30, 60, 120, 180, 300, 450, 600, 900, 1200, 1800, 3600, 7200)
+
+
+class PhaseTracer(object):
+    '''
+    Records when each headnode first went through each provisioning event:
+    its states (new, booting, initializing, running, failure, terminated),
+    and the events in between: Nova reporting it ACTIVE (active), the first
+    ssh login (ssh), and the start and end of its playbook run
+    (ansible_start, ansible_end). The time between events, and the time
+    spent in each state, are observed in histograms labelled by app_type and
+    flavor.
+
+    Records are kept in table (a dictionary, or a JournalTable so that a
+    restart does not lose them), and forgotten when the headnode is
+    terminated. Times are wall clock times, since they have to survive
+    restarts.
+    '''
+    # (phase, from event, to event)
+    phases = [
+        ('boot',    'new',           'active'),
+        ('ssh',     'active',        'ssh'),
+        ('queue',   'initializing',  'ansible_start'),
+        ('ansible', 'ansible_start', 'ansible_end'),
+        ('total',   'new',           'running'),
+    ]
+
+    def __init__(self, metrics, table):
+        self.log   = logging.getLogger()
+        self.table = table
+
+        self.m_phase = metrics.histogram('vc3_headnode_phase_seconds', 'Duration of headnode provisioning phases, by phase, app_type and flavor.', PHASE_BUCKETS)
+        self.m_state = metrics.histogram('vc3_headnode_state_seconds', 'Time headnodes spent in each state, by state, app_type and flavor.', PHASE_BUCKETS)
+
+    def mark(self, name, event, when = None, **labels):
+        '''
+        Records event for the headnode of request name, unless it was
+        already recorded. labels are app_type and flavor.
+        '''
+        record = self.get(name) or { 'events' : {}, 'labels' : labels, 'state' : None, 'since' : None }
+        if record['events'].has_key(event):
+            return
+
+        if when is None:
+            when = time.time()
+        record['events'][event] = when
+        if labels:
+            record['labels'] = labels
+        self.table[name] = record
+
+        for (phase, start, end) in self.phases:
+            if end == event and record['events'].has_key(start):
+                elapsed = when - record['events'][start]
+                self.m_phase.observe(elapsed, phase = phase, **record['labels'])
+                self.log.debug("Headnode for %s: phase %s took %.0f seconds." % (name, phase, elapsed))
+
+    def transition(self, name, old, new, **labels):
+        '''
+        Records that the headnode of request name went from state old to
+        state new in this cycle.
+        '''
+        if old == new:
+            return
+
+        now = time.time()
+        self.mark(name, new, now, **labels)
+
+        record = self.get(name)
+        if record['state'] == old and record['since'] is not None:
+            self.m_state.observe(now - record['since'], state = old, **record['labels'])
+        record['state'] = new
+        record['since'] = now
+
+        if new == 'terminated':
+            self.forget(name)
+        else:
+            self.table[name] = record
+
+    def get(self, name):
+        # a copy, so that the table sees the changes when it is stored back.
+        return copy.deepcopy(self.table.get(name, None))
+
+    def forget(self, name):
+        self.table.pop(name, None)
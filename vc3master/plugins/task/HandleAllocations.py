@@ -2,15 +2,15 @@
 
 import ConfigParser
 import StringIO
-from base64 import b64encode, b64decode
 
 import os
 import json
+import time
 import traceback
-import subprocess
-import tempfile
 
 from vc3master.task import VC3Task
+from vc3master.tracking import ChangeTracker
+from vc3master.validation import LoginCheck, LoginValidator
 from vc3infoservice.infoclient import InfoConnectionFailure, InfoEntityMissingException
 
 import pluginmanager as pm
@@ -20,9 +20,33 @@ class HandleAllocations(VC3Task):
     Plugin to manage the life cycle of all Allocations.
      
     '''
+    prefetch = ['Allocation', 'Resource']
+
     def __init__(self, parent, config, section):
         super(HandleAllocations, self).__init__(parent, config, section)
         self.client = parent.client
+        self.tracker = ChangeTracker(self.client, self.metrics, 'HandleAllocations')
+
+        # allocations asking for validation are checked concurrently at the
+        # start of the cycle: at most validation_concurrency logins at a time,
+        # validation_per_host of them to the same host, each killed after
+        # validation_deadline seconds. Successful results are reused for
+        # validation_ttl seconds.
+        options = { 'validation_concurrency' : 8, 'validation_per_host' : 2, 'validation_deadline' : 30, 'validation_ttl' : 300 }
+        for option in options.keys():
+            if self.config.has_option(section, option):
+                options[option] = int(self.config.get(section, option))
+
+        self.validator = LoginValidator(self.metrics,
+                max_concurrency = options['validation_concurrency'],
+                per_host        = options['validation_per_host'],
+                deadline        = options['validation_deadline'],
+                ttl             = options['validation_ttl'],
+                sshpool         = self.parent.parent.sshpool)
+
+        # allocation name -> (ok, message) of the validations of this cycle.
+        self.validations = {}
+
         self.log.debug("HandleAllocations VC3Task initialized.")
 
     def runtask(self):
@@ -33,16 +57,49 @@ class HandleAllocations(VC3Task):
             allocations = self.client.listAllocations()
             n = len(allocations) if allocations else 0
             self.log.debug("Processing %d allocations" % n)
+            self.processed = n
+            self.tracker.clear()
+            # only new allocations need keys; the rest were already given theirs.
+            new = [a.name for a in allocations or [] if a.state == 'new']
+            self.parent.parent.keys.retain(new)
             if allocations:
+                # keys of new allocations are generated while we do the rest.
+                self.parent.parent.keys.warm(new)
+                self.validate_all(allocations)
                 for a in allocations:
                     self.process_allocation(a)
         except InfoConnectionFailure, e:
             self.log.warning("Could not read allocations from infoservice. (%s)", e)
     
+    def validate_all(self, allocations):
+        '''
+        Validates concurrently all allocations that will be validated in
+        this cycle, so that state_configured only reads the results.
+        '''
+        checks = []
+        for allocation in allocations:
+            if allocation.action != 'validate' or allocation.state not in ('configured', 'validation_failure'):
+                continue
+            try:
+                checks.append(self.login_check(allocation))
+            except Exception, e:
+                # state_configured reports it.
+                self.log.debug("Could not prepare validation of allocation %s (%s)", allocation.name, e)
+
+        self.validations = self.validator.validate_all([c for c in checks if c is not None])
+
+    def login_check(self, allocation):
+        resource = self.client.getResource(allocation.resource)
+        if resource.accessmethod not in ('ssh', 'gsissh', 'sshproxy'):
+            return None
+        return LoginCheck(allocation.name, resource.accessmethod, resource.accesshost, resource.accessport, allocation.accountname, allocation.privtoken)
+
     def process_allocation(self, allocation):
         next_state  = allocation.state
         reason      = None
 
+        self.tracker.track(allocation)
+
         self.log.debug("Processing allocation '%s'", allocation.name)
         if next_state == 'new': 
             # nexts: configured, failure
@@ -64,16 +121,17 @@ class HandleAllocations(VC3Task):
             # nexts: failure
             (next_state, reason) = self.state_failure(allocation)    
 
-        if (next_state is not allocation.state) or (reason is not allocation.state_reason):
-            try:
-                self.log.debug("allocation '%s'  state '%s' -> %s'", allocation.name, allocation.state, next_state)
-                allocation.state        = next_state
-                allocation.state_reason = reason
-                self.client.storeAllocation(allocation)
+        if next_state != allocation.state:
+            self.log.debug("allocation '%s'  state '%s' -> %s'", allocation.name, allocation.state, next_state)
 
-            except Exception, e:
-                self.log.warning("Storing the new Allocation state failed.")
-                raise e
+        allocation.state        = next_state
+        allocation.state_reason = reason
+
+        try:
+            self.tracker.store(allocation)
+        except Exception, e:
+            self.log.warning("Storing the new Allocation state failed.")
+            raise e
 
     def state_new(self, allocation):
         '''
@@ -83,7 +141,10 @@ class HandleAllocations(VC3Task):
         try:
             resource = self.client.getResource(allocation.resource)
             if resource.accessmethod == 'ssh':
-                self.generate_auth_tokens(allocation)
+                if not self.generate_auth_tokens(allocation):
+                    # look again soon, instead of a full polling interval later.
+                    self.parent.trigger(time.time() + 5)
+                    return ('new', 'Generating SSH credentials.')
             elif resource.accessmethod in ('gsissh', 'sshproxy'):
                 # do we need to do anything?
                 self.log.debug('Resource access method is %s' % resource.accessmethod)
@@ -110,16 +171,19 @@ class HandleAllocations(VC3Task):
 
             if resource.accessmethod in ('ssh', 'gsissh', 'sshproxy'):
                 self.log.debug('Attempting to contact %s to validate allocation %s' % (resource.accesshost, allocation.name))
-                self.validate(allocation, resource) # raises exception on failure
+                result = self.validations.pop(allocation.name, None)
+                if result is None:
+                    result = self.validator.validate(self.login_check(allocation))
+                (ok, message) = result
+                if not ok:
+                    self.log.debug('Allocation %s could not be validated: %s' % (allocation.name, message))
+                    return ('validation_failure', 'Could not validate allocation.')
                 self.log.debug('Allocation %s has been validated.' % (allocation.name,))
                 return ('ready', 'Allocation credentials were used succesfully to login into the resource.')
             else:
                 self.log.debug('Cannot yet validate using %s' % resource.accessmethod)
                 return ('failure', 'Only resources that can be contacted through gsissh/ssh can be validated at this time.')
 
-        except subprocess.CalledProcessError, e:
-            self.log.debug('Allocation %s could not be validated: %s' % (allocation.name, e))
-            return ('validation_failure', 'Could not validate allocation.')
         except InfoConnectionFailure, e:
             allocation.action = 'validate'
             return ('configured', 'Could not validate allocation because of a transient connectivity error. Trying again.')
@@ -141,45 +205,19 @@ class HandleAllocations(VC3Task):
 
     def generate_auth_tokens(self, allocation):
         """ 
-        Generate SSH priv/pub keys and base64 encode them, placing them in allocation 
+        Places the base64 encoded SSH priv/pub keys in allocation. Returns
+        False if the keys are still being generated.
         """ 
         self.log.info("Generating or retrieving SSH keys for %s", allocation.name)
-        self.ssh = self.parent.parent.ssh
-        (pub, priv) = self.ssh.getkeys(allocation.name)
-        self.log.debug("public key: %s", pub)
-        encoded_pub = b64encode(pub)
-        encoded_priv = b64encode(priv)
+        keys = self.parent.parent.keys.get(allocation.name)
+        if keys is None:
+            return False
+        (encoded_pub, encoded_priv) = keys
+        self.log.debug("public key: %s", encoded_pub)
         allocation.sectype = "ssh-rsa"
         allocation.pubtoken = encoded_pub
         allocation.privtoken = encoded_priv
-        
-    def validate(self, allocation, resource):
-        with tempfile.NamedTemporaryFile(mode='w+b', bufsize=0, delete=False) as fh:
-            fh.write(b64decode(allocation.privtoken))
-            fh.seek(0)
-            fh.flush()
-            self.log.debug("Wrote temporary file %s", fh.name)
-
-            os.chmod(fh.name, 0400)
-            if resource.accessmethod in ('ssh', 'sshproxy'):
-                subprocess.check_call([
-                    'ssh', 
-                    '-o', 'UserKnownHostsFile=/dev/null',
-                    '-o', 'StrictHostKeyChecking=no',
-                    '-o', 'ConnectTimeout=10',
-                    '-i', fh.name,
-                    '-l', allocation.accountname,
-                    '-p', resource.accessport,
-                    resource.accesshost, '--', '/bin/date'])
-            elif resource.accessmethod == 'gsissh':
-                cmdlist = [
-                    'gsissh', 
-                    '-o', 'UserKnownHostsFile=/dev/null',
-                    '-o', 'StrictHostKeyChecking=no',
-                    '-o', 'ConnectTimeout=10',
-                    '-p', str(resource.accessport),
-                    resource.accesshost, '--', '/bin/date']
-                self.log.debug("Attempting to run: %s", cmdlist)
-                subprocess.check_call(cmdlist,env={"X509_USER_PROXY":fh.name})
-            else:
-                self.log.error("Can only validate ssh, gsissh accessmethods")
+        # the allocation has them now; if storing it fails, they are read
+        # from the keystore again.
+        self.parent.parent.keys.forget(allocation.name)
+        return True
@@ -2,16 +2,24 @@
 
 
 from vc3master.task import VC3Task
+from vc3master.tracking import ChangeTracker
+from vc3master.probe import ProbeEngine
+from vc3master.inventory import NovaInventory
+from vc3master.provision import ProvisionExecutor, ProvisionBatch, HostJob
+from vc3master.journal import Journal
+from vc3master.deadlines import DeadlineIndex
+from vc3master.phases import PhaseTracer
+from vc3master.members import ProjectMembership
+from vc3master.warmpool import WarmPool, parse_sizes
 from vc3infoservice.infoclient import InfoConnectionFailure, InfoEntityMissingException
 
 from base64 import b64encode
 import pluginmanager as pm
 import traceback
 
+import itertools
 import json
 import os
-import re
-import subprocess
 import time
 
 from novaclient import client as novaclient
@@ -21,11 +29,15 @@ class HandleHeadNodes(VC3Task):
     Plugin to manage the head nodes lifetime.
      
     '''
+    # listings are prefetched per cycle by prefetch_for(), from the requests.
+    prefetch = []
 
     def __init__(self, parent, config, section):
         super(HandleHeadNodes, self).__init__(parent, config, section)
         self.client = parent.client
         self.config = config
+        self.tracker = ChangeTracker(self.client, self.metrics, 'HandleHeadNodes')
+        self.members = ProjectMembership(self.client, self.metrics)
 
         nova_conf = {
                 'version' : '2.0',
@@ -38,6 +50,9 @@ class HandleHeadNodes(VC3Task):
 
         self.nova = novaclient.Client( **nova_conf );
 
+        # servers are listed once per cycle, and looked up by name from this index.
+        self.inventory = NovaInventory(self.nova, self.metrics)
+
         self.node_prefix           = self.config.get(section, 'node_prefix')
 
         self.node_image            = self.config.get(section, 'node_image')
@@ -53,19 +68,108 @@ class HandleHeadNodes(VC3Task):
         self.ansible_path       = os.path.expanduser(self.config.get(section, 'ansible_path'))
         self.ansible_playbook   = self.config.get(section, 'ansible_playbook')
 
-        self.ansible_debug_file = os.path.expanduser(self.config.get(section, 'ansible_debug_file')) # temporary for debug, only works for one node at a time
-        self.ansible_debug      = open(self.ansible_debug_file, 'a')
+        # each ansible run logs to its own file in ansible_log_dir.
+        if self.config.has_option(section, 'ansible_log_dir'):
+            self.ansible_log_dir = os.path.expanduser(self.config.get(section, 'ansible_log_dir'))
+        else:
+            self.ansible_log_dir = os.path.dirname(os.path.expanduser(self.config.get(section, 'ansible_debug_file')))
+
+        self.ansible_max_running = 4
+        if self.config.has_option(section, 'ansible_max_running'):
+            self.ansible_max_running = int(self.config.get(section, 'ansible_max_running'))
+
+        # ansible runs adopted after a restart are failed after this many seconds.
+        ansible_max_age = 7200
+        if self.config.has_option(section, 'ansible_max_age'):
+            ansible_max_age = int(self.config.get(section, 'ansible_max_age'))
+
+        # logs of ansible runs are removed after this many seconds.
+        ansible_log_max_age = 7 * 24 * 3600
+        if self.config.has_option(section, 'ansible_log_max_age'):
+            ansible_log_max_age = int(self.config.get(section, 'ansible_log_max_age'))
+
+        self.executor = ProvisionExecutor(self.metrics, self.ansible_max_running, self.ansible_log_dir, ansible_max_age, ansible_log_max_age)
+
+        # with ansible_batch_size > 1, headnodes waiting for the same playbook
+        # are configured together by one ansible run of up to that many hosts,
+        # with ansible_forks hosts in parallel.
+        self.ansible_batch_size = 1
+        if self.config.has_option(section, 'ansible_batch_size'):
+            self.ansible_batch_size = int(self.config.get(section, 'ansible_batch_size'))
+
+        self.ansible_forks = 10
+        if self.config.has_option(section, 'ansible_forks'):
+            self.ansible_forks = int(self.config.get(section, 'ansible_forks'))
+
+        # playbook -> ProvisionBatch being filled in this cycle.
+        self.batches       = {}
+        self.batch_counter = itertools.count()
 
         groups = self.config.get(section, 'node_security_groups')
         self.node_security_groups = groups.split(',')
 
+        # the state below survives restarts when state_journal is set.
+        state_journal = None
+        if self.config.has_option(section, 'state_journal'):
+            state_journal = self.config.get(section, 'state_journal')
+        self.journal = Journal(state_journal)
+
+        # request name -> ProvisionJob of its current initialization. Saved
+        # to the journal by checkpoint().
         self.initializers = {}
 
+        # request name -> time of its first initialization attempt, used to
+        # provision the oldest requests first.
+        self.provision_priority = self.journal.table('provision_priority')
+
         # keep las succesful contact to node, to check against node_max_no_contact_time.
-        self.last_contact_times = {}
+        self.last_contact_times = self.journal.table('last_contact_times')
 
         # number of times we have tries to initialize a node. After node_max_initializing_count, declare failure.
-        self.initializing_count = {}
+        self.initializing_count = self.journal.table('initializing_count')
+
+        # request name -> time its headnode is declared failed if it is
+        # still not contacted, so that the taskset wakes up for it. Set
+        # together with last_contact_times by record_contact().
+        self.contact_deadlines = DeadlineIndex()
+        for (name, when) in self.last_contact_times.items():
+            self.contact_deadlines.set(name, when + self.node_max_no_contact_time)
+
+        # when each headnode went through each provisioning step.
+        self.phases = PhaseTracer(self.metrics, self.journal.table('phases'))
+
+        # ssh liveness checks of all headnodes run concurrently at the start of the cycle.
+        probe_concurrency = 16
+        if self.config.has_option(section, 'probe_concurrency'):
+            probe_concurrency = int(self.config.get(section, 'probe_concurrency'))
+        probe_deadline = 15
+        if self.config.has_option(section, 'probe_deadline'):
+            probe_deadline = int(self.config.get(section, 'probe_deadline'))
+        self.probes = ProbeEngine(self.metrics, probe_concurrency, probe_deadline, sshpool = parent.parent.sshpool)
+
+        # optional pool of pre-booted headnodes, e.g. warmpool_size = htcondor:2
+        self.warmpool = None
+        self.warm_requests = self.journal.table('warm_requests')
+        # requests given a pool VM before a restart still need the request
+        # playbook, even if the pool is now off.
+        self.warmpool_base_playbook = 'login-{app_type}-base.yaml'
+        if self.config.has_option(section, 'warmpool_base_playbook'):
+            self.warmpool_base_playbook = self.config.get(section, 'warmpool_base_playbook')
+        self.warmpool_request_playbook = 'login-{app_type}-request.yaml'
+        if self.config.has_option(section, 'warmpool_request_playbook'):
+            self.warmpool_request_playbook = self.config.get(section, 'warmpool_request_playbook')
+        if self.config.has_option(section, 'warmpool_size') and self.config.get(section, 'warmpool_size').strip():
+            sizes  = parse_sizes(self.config.get(section, 'warmpool_size'))
+            budget = sum(sizes.values())
+            if self.config.has_option(section, 'warmpool_budget'):
+                budget = int(self.config.get(section, 'warmpool_budget'))
+            timeouts = {}
+            for option in ['boot_timeout', 'configure_timeout']:
+                if self.config.has_option(section, 'warmpool_' + option):
+                    timeouts[option] = int(self.config.get(section, 'warmpool_' + option))
+            self.warmpool = WarmPool(self.nova, self.inventory, self.metrics, self.executor, sizes, budget, self.node_prefix, self.boot_args(), self.pool_vm_is_alive, self.pool_vm_command, **timeouts)
+
+        self.recover()
 
         self.log.debug("HandleHeadNodes VC3Task initialized.")
 
@@ -74,9 +178,16 @@ class HandleHeadNodes(VC3Task):
         self.log.debug("Polling master....")
 
         try:
-            requests = self.client.listRequests()
-            n = len(requests) if requests else 0
+            # requests are only read here, so a recent shared listing will do.
+            requests = self.parent.parent.snapshots.current().requests()
+            n = len(requests)
             self.log.debug("Processing %d requests" % n)
+            self.processed = n
+            self.tracker.clear()
+            self.prefetch_for(requests)
+            self.inventory.refresh()
+            self.executor.poll()
+            self.probe_headnodes(requests)
             if requests:
                 for r in requests:
                     try:
@@ -84,15 +195,123 @@ class HandleHeadNodes(VC3Task):
                     except Exception, e:
                         self.log.warning("Request %s had an exception (%s)", r.name, e)
                         self.log.debug(traceback.format_exc(None))
+            if self.warmpool:
+                self.warmpool.maintain()
+            self.submit_batches()
+            self.checkpoint()
+            self.members.prune()
+
+            # requests removed without going through terminating.
+            names = set([r.name for r in requests])
+            for name in self.contact_deadlines.keys():
+                if name not in names:
+                    self.forget_contact(name)
+
+            deadline = self.contact_deadlines.next_deadline()
+            if deadline is not None:
+                self.parent.trigger(deadline + 1)
         except InfoConnectionFailure, e:
             self.log.warning("Could not read requests from infoservice. (%s)", e)
 
+    def stop(self):
+        self.checkpoint()
+        self.journal.close()
+
+    def checkpoint(self):
+        '''
+        Saves to the journal what is needed to adopt the running initializers
+        after a restart.
+        '''
+        table = self.journal.table('initializers')
+        for name in table.keys():
+            if not self.initializers.has_key(name):
+                table.pop(name, None)
+
+        for (name, job) in self.initializers.items():
+            record = { 'key' : job.key, 'pid' : None, 'identity' : None, 'started' : None, 'logfile' : None, 'files' : [], 'host' : None }
+            if isinstance(job, HostJob):
+                record['host'] = job.host
+                job = job.batch.job
+            if job is not None:
+                record['pid']      = job.pid
+                record['identity'] = job.identity
+                record['started']  = job.started
+                record['logfile']  = job.logfile
+                record['files']    = job.files
+            table[name] = record
+
+    def recover(self):
+        '''
+        Adopts the initializers that were running when the master stopped, so
+        that their headnodes are not configured again.
+        '''
+        table = self.journal.table('initializers')
+        for (name, record) in table.items():
+            if record['pid'] is None:
+                # it never started, so it does not count as a try.
+                self.log.info("Initializer for %s had not started, it will be submitted again.", name)
+                table.pop(name, None)
+                count = self.initializing_count.get(name, 0)
+                if count > 0:
+                    self.initializing_count[name] = count - 1
+                continue
+
+            job = self.executor.adopt(record['key'], self.provision_priority.get(name, time.time()), record['pid'], record['logfile'], record.get('identity', None), record.get('started', None), record.get('files', None))
+            if record['host'] is not None:
+                batch = ProvisionBatch(record['key'], None)
+                batch.job = job
+                job = HostJob(batch, record['host'])
+            self.initializers[name] = job
+
+        if self.initializers:
+            self.log.info("Recovered %d initializers from the journal.", len(self.initializers))
+
+    def prefetch_for(self, requests):
+        '''
+        Lists in bulk only the kinds of entities this cycle will look up more
+        than once. Single lookups are read one by one through the cache.
+        Clusters, environments and projects are only read while headnodes
+        are being created and configured.
+        '''
+        with_headnode = [r for r in requests if r.headnode]
+        initializing  = [r for r in with_headnode if r.state == 'initializing']
+
+        kinds = []
+        if len(with_headnode) > 1:
+            kinds.append('Nodeset')
+        if len(initializing) > 1:
+            kinds.extend(['Cluster', 'Environment', 'Project'])
+
+        if kinds:
+            self.client.prefetch(kinds)
+
+    def probe_headnodes(self, requests):
+        '''
+        Checks all headnodes with an address concurrently, so that
+        check_if_online during the cycle only reads the results.
+        '''
+        self.probes.begin_cycle()
+
+        targets = []
+        for request in requests:
+            if not request.headnode:
+                continue
+            try:
+                headnode = self.client.getNodeset(request.headnode)
+            except Exception:
+                continue
+            if headnode.app_host and headnode.state in ['booting', 'initializing', 'running']:
+                targets.append((headnode.app_host, self.node_user, self.node_private_key_file))
+
+        self.probes.probe_all(targets)
+
     def process_request(self, request):
         self.log.debug("Processing headnode for '%s'", request.name)
 
-        headnode    = None
-        next_state  = None
-        reason      = None
+        headnode       = None
+        next_state     = None
+        previous_state = None
+        reason         = None
 
         if not request.headnode:
             # Request has not yet indicated the name it wants for the headnode,
@@ -101,6 +320,7 @@ class HandleHeadNodes(VC3Task):
 
         try:
             headnode = self.client.getNodeset(request.headnode)
+            self.tracker.track(headnode)
         except InfoEntityMissingException:
             pass
         except InfoConnectionFailure:
@@ -112,6 +332,7 @@ class HandleHeadNodes(VC3Task):
                     headnode = self.create_headnode_nodeset(request)
                 elif request.state == 'cleanup' or request.state == 'terminated':
                     # Nothing to do, the headnode has been cleaned-up
+                    self.forget_contact(request.name)
                     return
                 else:
                     # Something went wrong, the headnode should still be there.
@@ -119,6 +340,7 @@ class HandleHeadNodes(VC3Task):
                     return
 
             next_state, reason = headnode.state, headnode.state_reason
+            previous_state     = headnode.state
 
             if request.state == 'cleanup' or request.state == 'terminated':
                 (next_state, reason) = self.state_terminating(request, headnode)
@@ -147,6 +369,14 @@ class HandleHeadNodes(VC3Task):
             else:
                 raise
 
+        if next_state in ['failure', 'terminated']:
+            self.forget_contact(request.name)
+
+        try:
+            self.phases.transition(request.name, previous_state, next_state, **self.phase_labels(headnode))
+        except Exception, e:
+            self.log.debug("Could not record headnode phases for %s (%s)", request.name, e)
+
         headnode.state        = next_state
         headnode.state_reason = reason
 
@@ -154,7 +384,7 @@ class HandleHeadNodes(VC3Task):
             if headnode.state == 'terminated':
                 self.delete_headnode_nodeset(request)
             else:
-                self.client.storeNodeset(headnode)
+                self.tracker.store(headnode)
         except Exception, e:
             self.log.warning("Storing the new headnode state failed. (%s)", e)
             self.log.warning(traceback.format_exc(None))
@@ -164,23 +394,52 @@ class HandleHeadNodes(VC3Task):
             if headnode.state != 'terminated':
                 if self.initializers.get(request.name, None):
                     try:
-                        proc = self.initializers[request.name]
-                        proc.terminate()
+                        self.cancel_initializer(request.name)
                     except Exception, e:
                         self.log.warning('Exception while killing initializer for %s: %s', request.name, e)
 
-                server = self.nova.servers.find(name=self.vm_name(request))
+                server = self.inventory.find(self.vm_name(request))
+                if server is None:
+                    raise Exception('no server named %s' % self.vm_name(request))
                 self.log.debug('Teminating headnode %s for request %s', request.headnode, request.name)
                 server.delete()
+                self.inventory.remove(self.vm_name(request))
 
                 self.initializers.pop(request.name, None)
-                self.last_contact_times.pop(request.name, None)
+                self.provision_priority.pop(request.name, None)
+                self.warm_requests.discard(request.name)
+                self.forget_contact(request.name)
                 self.initializing_count.pop(request.name, None)
         except Exception, e:
             self.log.warning('Could not find headnode instance for request %s (%s)', request.name, e)
         finally:
             return ('terminated', 'Headnode succesfully terminated')
 
+    def cancel_initializer(self, name):
+        '''
+        Stops configuring the headnode of request name. A host waiting in a
+        batch is dropped from it; a running batch is only killed when no
+        other headnode is configured by it.
+        '''
+        job = self.initializers[name]
+        if not isinstance(job, HostJob):
+            self.executor.cancel(job.key)
+            return
+
+        batch = job.batch
+        if batch.job is None:
+            batch.hosts.pop(job.host, None)
+            if not batch.hosts and self.batches.get(batch.playbook, None) is batch:
+                self.batches.pop(batch.playbook)
+            self.log.debug('Dropped headnode of %s from batch %s', name, batch.key)
+            return
+
+        others = [n for (n, j) in self.initializers.items() if n != name and j.key == job.key]
+        if others:
+            self.log.info('Cannot cancel initializer of %s, batch %s is also configuring %s', name, job.key, ', '.join(others))
+            return
+        self.executor.cancel(job.key)
+
     def state_new(self, request, headnode):
         self.log.info('Creating new nodeset %s for request %s', request.headnode, request.name)
 
@@ -201,9 +460,11 @@ class HandleHeadNodes(VC3Task):
         if not headnode.app_host:
             headnode.app_host = self.__get_ip(request)
             if headnode.app_host:
-                self.last_contact_times[request.name] = time.time()
+                self.record_contact(request.name)
+                self.phases.mark(request.name, 'active', **self.phase_labels(headnode))
 
         if self.check_if_online(request, headnode):
+            self.phases.mark(request.name, 'ssh', **self.phase_labels(headnode))
             return ('initializing', 'Headnode is being configured.')
         else: 
             self.log.debug('Headnode for %s could not yet be used for login.', request.name)
@@ -216,7 +477,7 @@ class HandleHeadNodes(VC3Task):
         (next_state, state_reason) = self.check_if_done_init(request, headnode)
 
         if self.check_if_online(request, headnode):
-            self.last_contact_times[request.name] = time.time()
+            self.record_contact(request.name)
 
         if next_state == 'running':
             self.log.info('Done initializing server %s for request %s', request.headnode, request.name)
@@ -228,7 +489,7 @@ class HandleHeadNodes(VC3Task):
 
     def state_running(self, request, headnode):
         if self.check_if_online(request, headnode):
-            self.last_contact_times[request.name] = time.time()
+            self.record_contact(request.name)
 
         return ('running', 'Headnode is ready to be used.')
 
@@ -238,68 +499,91 @@ class HandleHeadNodes(VC3Task):
             self.log.debug('Headnode for %s does not have an address yet.', request.name)
             return False
 
-        try:
-            self.log.debug("Connecting to headnode %s with key %s as user %s", headnode.app_host, self.node_private_key_file, self.node_user )
-            subprocess.check_call([
-                'ssh',
-                '-o',
-                'UserKnownHostsFile=/dev/null',
-                '-o',
-                'StrictHostKeyChecking=no',
-                '-o',
-
-                'ConnectTimeout=10',
-                '-i',
-                self.node_private_key_file,
-                '-l',
-                self.node_user,
-                headnode.app_host,
-                '--',
-                '/bin/date'])
-
+        self.log.debug("Connecting to headnode %s with key %s as user %s", headnode.app_host, self.node_private_key_file, self.node_user )
+        if self.probes.is_alive(headnode.app_host, self.node_user, self.node_private_key_file):
             self.log.info('Headnode for %s running at %s', request.name, headnode.app_host)
-
             return True
-        except subprocess.CalledProcessError:
+        else:
             self.log.debug('Headnode for %s running at %s could not be accessed.', request.name, headnode.app_host)
             return False
 
+    def record_contact(self, request_name, when = None):
+        if when is None:
+            when = time.time()
+        self.last_contact_times[request_name] = when
+        self.contact_deadlines.set(request_name, when + self.node_max_no_contact_time)
+
+    def forget_contact(self, request_name):
+        self.last_contact_times.pop(request_name, None)
+        self.contact_deadlines.remove(request_name)
+
     def check_timeout(self, request, next_state, reason):
         now = time.time()
 
-        diff = 0
-
-        if self.last_contact_times.has_key(request.name):
-            diff = now - self.last_contact_times[request.name]
-        else:
-            self.last_contact_times[request.name] = now
+        deadline = self.contact_deadlines.get(request.name)
+        if deadline is None:
+            self.record_contact(request.name, now)
             return (next_state, reason)
 
-        self.log.debug('Headnode for %s last contacted %d seconds ago.', request.name, diff)
+        remaining = deadline - now
+        self.log.debug('Headnode for %s last contacted %d seconds ago.', request.name, self.node_max_no_contact_time - remaining)
 
-        if diff > self.node_max_no_contact_time:
+        if remaining < 0:
             self.log.warning('Headnode for %s could not be contacted after %d seconds. Declaring failure.', request.name, self.node_max_no_contact_time)
             return ('failure', 'Headnode could no be contacted after %d seconds.' % self.node_max_no_contact_time)
-        elif diff > self.node_max_no_contact_time/2:
-            self.log.warning('Headnode for %s could not be contacted! (waiting for %d seconds before declaring failure)', request.name, self.node_max_no_contact_time - diff)
-            reason = reason + " (Headnode could not be contacted. This may be a transient error. Waiting for {:.0f} seconds before declaring failure.)".format(self.node_max_no_contact_time - diff)
+        elif remaining < self.node_max_no_contact_time/2:
+            self.log.warning('Headnode for %s could not be contacted! (waiting for %d seconds before declaring failure)', request.name, remaining)
+            reason = reason + " (Headnode could not be contacted. This may be a transient error. Waiting for {:.0f} seconds before declaring failure.)".format(remaining)
             return (next_state, reason)
         else:
             return (next_state, reason)
 
     def boot_server(self, request, headnode):
-        try:
-            server = self.nova.servers.find(name = self.vm_name(request))
+        server = self.inventory.find(self.vm_name(request))
+        if server is not None:
             self.log.info('Found headnode at %s for request %s', request.headnode, request.name)
             return server
-        except Exception, e:
-            pass
+
+        if self.warmpool and headnode.app_type is not None:
+            server = self.warmpool.claim(headnode.app_type, self.vm_name(request))
+            if server is not None:
+                self.log.info('Using pre-booted headnode for request %s', request.name)
+                self.warm_requests.add(request.name)
+                return server
 
         self.log.info('Booting new headnode for request %s...', request.name)
-        server = self.nova.servers.create(name = self.vm_name(request), image = self.node_image, flavor = self.node_flavor, key_name = self.node_public_key_name, security_groups = self.node_security_groups, nics = [{'net-id' : self.node_network_id}])
+        server = self.nova.servers.create(name = self.vm_name(request), **self.boot_args())
+        self.inventory.add(server)
 
         return server
 
+    def boot_args(self):
+        return { 'image' : self.node_image, 'flavor' : self.node_flavor, 'key_name' : self.node_public_key_name, 'security_groups' : self.node_security_groups, 'nics' : [{'net-id' : self.node_network_id}] }
+
+    def pool_vm_is_alive(self, host):
+        return self.probes.is_alive(host, self.node_user, self.node_private_key_file)
+
+    def pool_vm_command(self, app_type, host):
+        '''
+        ansible run of the base playbook of app_type on a warm pool VM. Only
+        the steps that do not depend on a request go in the base playbook.
+        '''
+        extra_vars = {}
+        extra_vars['headnode_ip']     = host
+        extra_vars['setup_user_name'] = self.node_user
+
+        playbook = os.path.join(self.ansible_path, self.warmpool_base_playbook.format(app_type = app_type))
+        argv = ['ansible-playbook',
+                playbook,
+                '--extra-vars',
+                json.dumps(extra_vars),
+                '--key-file',
+                self.node_private_key_file,
+                '--inventory',
+                host + ',',
+                ]
+        return (argv, self.ansible_path, self.ansible_env())
+
 
     def initialize_server(self, request, headnode):
 
@@ -311,8 +595,6 @@ class HandleHeadNodes(VC3Task):
 
         self.log.info("Trying to initialize headnode for request %s for the %d/%d time." % (request.name, self.initializing_count[request.name], self.node_max_initializing_count))
 
-        os.environ['ANSIBLE_HOST_KEY_CHECKING']='False'
-
         extra_vars  = {}
         extra_vars['request_name']       = request.name
         extra_vars['request_owner']      = request.owner
@@ -323,47 +605,98 @@ class HandleHeadNodes(VC3Task):
         extra_vars['shared_secret_file'] = self.secret_auth_filename(request)
         extra_vars['globusvc3_mapfile']  = self.get_globusvc3_mapfile(request)
 
-        app_type = headnode.app_type
-        if app_type is not None:
-            playbook_name = "login-" + app_type + ".yaml"
-            self.ansible_playbook = os.path.join(self.ansible_path, playbook_name)
+        playbook = self.playbook_for(request, headnode)
+        self.log.debug("playbook path : %s", playbook)
 
-        self.log.debug("playbook path : %s", self.ansible_playbook)
+        priority = self.provision_priority.setdefault(request.name, time.time())
 
-        # passing extra-vars as a command line argument for now. That won't
-        # scale well, we want to write those vars to a file instead.
-        pipe = subprocess.Popen(
-                ['ansible-playbook',
-                    self.ansible_playbook,
+        if self.ansible_batch_size > 1:
+            # the run starts at the end of the cycle, see submit_batches.
+            self.initializers[request.name] = self.add_to_batch(playbook, headnode.app_host, extra_vars, priority)
+        else:
+            # passing extra-vars as a command line argument for now. That won't
+            # scale well, we want to write those vars to a file instead.
+            argv = ['ansible-playbook',
+                    playbook,
                     '--extra-vars',
                     json.dumps(extra_vars),
                     '--key-file',
                     self.node_private_key_file,
                     '--inventory',
                     headnode.app_host + ',',
-                    ],
-                cwd = self.ansible_path,
-                stdout=self.ansible_debug,
-                stderr=self.ansible_debug,
-                )
-        self.initializers[request.name] = pipe
-        self.last_contact_times[request.name] = time.time()
+                    ]
+            self.initializers[request.name] = self.executor.submit(request.name, priority, argv, self.ansible_path, self.ansible_env())
+        self.record_contact(request.name)
+
+    def playbook_for(self, request, headnode):
+        if request.name in self.warm_requests:
+            # the base playbook already ran on headnodes from the warm pool.
+            return os.path.join(self.ansible_path, self.warmpool_request_playbook.format(app_type = headnode.app_type))
+        if headnode.app_type is not None:
+            return os.path.join(self.ansible_path, "login-" + headnode.app_type + ".yaml")
+        return os.path.join(self.ansible_path, self.ansible_playbook)
+
+    def ansible_env(self):
+        env = dict(os.environ)
+        env['ANSIBLE_HOST_KEY_CHECKING'] = 'False'
+        return env
+
+    def add_to_batch(self, playbook, host, hostvars, priority):
+        batch = self.batches.get(playbook, None)
+        if batch is None or len(batch.hosts) >= self.ansible_batch_size:
+            if batch is not None:
+                self.submit_batch(batch)
+            name  = os.path.splitext(os.path.basename(playbook))[0]
+            batch = ProvisionBatch('batch-%s-%d' % (name, self.batch_counter.next()), playbook)
+            self.batches[playbook] = batch
+        return batch.add(host, hostvars, priority)
+
+    def submit_batches(self):
+        for batch in self.batches.values():
+            self.submit_batch(batch)
+        self.batches = {}
+
+    def submit_batch(self, batch):
+        '''
+        Starts one ansible run for all the hosts of batch, with the
+        variables of each host in a generated inventory file.
+        '''
+        inventory = batch.write_inventory(os.path.join(self.ansible_log_dir, batch.key + '-inventory.json'))
+
+        argv = ['ansible-playbook',
+                batch.playbook,
+                '--key-file',
+                self.node_private_key_file,
+                '--inventory',
+                inventory,
+                '--forks',
+                str(min(len(batch.hosts), self.ansible_forks)),
+                ]
+
+        self.log.info("Configuring %d headnodes with %s in one run (%s).", len(batch.hosts), batch.playbook, batch.key)
+        # the inventory holds the keys of the hosts, so it is removed with the job.
+        batch.job = self.executor.submit(batch.key, batch.priority, argv, self.ansible_path, self.ansible_env(), [inventory])
 
     def check_if_done_init(self, request, headnode):
         try:
-            pipe = self.initializers[request.name]
-            pipe.poll()
+            job = self.initializers[request.name]
+            self.executor.poll()
+
+            if job.is_queued():
+                return ('initializing', 'Headnode is waiting to be configured (%d ahead in queue).' % self.executor.position(job.key))
 
-            self.ansible_debug.flush()
+            self.phases.mark(request.name, 'ansible_start', job.started, **self.phase_labels(headnode))
 
-            if pipe.returncode is None:
+            if job.returncode is None:
                 return ('initializing', 'Headnode is being configured.')
 
             # the process is done when there is a returncode
             self.initializers.pop(request.name, None)
+            self.executor.pop(job.key)
+            self.phases.mark(request.name, 'ansible_end', job.finished, **self.phase_labels(headnode))
 
-            if pipe.returncode != 0:
-                self.log.warning('Error when initializing headnode for request %s. Exit status: %d', request.name, pipe.returncode)
+            if job.returncode != 0:
+                self.log.warning('Error when initializing headnode for request %s. Exit status: %d (see %s)', request.name, job.returncode, job.logfile)
                 
                 if self.initializing_count[request.name] >= self.node_max_initializing_count:
                     self.log.warning("Could not initialize headnode after %d tries." % (self.node_max_initializing_count,))
@@ -396,40 +729,25 @@ class HandleHeadNodes(VC3Task):
             contents = f.read()
             return self.client.encode(contents)
 
-    def get_members_names(self, request):
-        members = None
-
-        if request.project:
-            project = self.client.getProject(request.project)
-            if project:
-                members = project.members
-
-        if not members:
-            members = []
-            self.log.warning('Could not find user names for request %s.')
-
-        return members
-
     def _get_members_attributes(self, request, attribute):
-        members    = self.get_members_names(request)
+        membership = self.members.for_request(request)
 
-        attributes = {}
-        for member in members:
-            try:
-                user = self.client.getUser(member)
-            except Exception, e:
-                self.log.warning("Could not find user: %s", member)
-                raise e
+        if membership is None or not membership.members:
+            self.log.warning('Could not find user names for request %s.', request.name)
+            return {}
+
+        if membership.missing:
+            self.log.warning("Could not find user: %s", membership.missing[0])
+            raise InfoEntityMissingException("User %s is not defined." % membership.missing[0])
 
-            attr_value = getattr(user, attribute, None)
-            if not attr_value:
+        attributes = membership.attribute(attribute)
+        for member in membership.members:
+            if not attributes.has_key(member):
                 self.log.warning('Could not find attribute: %s, for user %s',
                                  attribute, member)
-            else:
-                attributes[member] = attr_value
 
         return attributes
-        
+
     def get_members_keys(self, request):
         return self._get_members_attributes(request, 'sshpubstring')
 
@@ -450,6 +768,9 @@ class HandleHeadNodes(VC3Task):
                 packages.extend(env.packagelist)
         return " ".join([ "--require %s" % p for p in packages ])
 
+    def phase_labels(self, headnode):
+        return { 'app_type' : headnode.app_type or 'none', 'flavor' : self.node_flavor }
+
     def create_headnode_nodeset(self, request):
         self.log.debug("Creating new headnode spec '%s'", request.headnode)
 
@@ -462,8 +783,10 @@ class HandleHeadNodes(VC3Task):
                 environment = None,
                 description = 'Headnode nodeset automatically created: ' + request.headnode,
                 displayname = request.headnode)
+        self.tracker.track(headnode, new = True)
 
-        self.last_contact_times[request.name] = time.time()
+        self.record_contact(request.name)
+        self.phases.mark(request.name, 'new', **self.phase_labels(headnode))
 
         return headnode
 
@@ -485,27 +808,21 @@ class HandleHeadNodes(VC3Task):
         return app_type
 
     def __get_ip(self, request):
-        try:
-            server = self.nova.servers.find(name=self.vm_name(request))
+        name   = self.vm_name(request)
+        status = self.inventory.status(name)
 
-            if server.status != 'ACTIVE':
-                self.log.debug("Headnode for request %s is not active yet.", request.name)
-                return None
-
-        except Exception, e:
-            self.log.warning('Could not find headnode for request %s (%s)', request.name, e)
+        if status is None:
+            self.log.warning('Could not find headnode for request %s', request.name)
             return None
 
-        try:
-            for network in server.networks.keys():
-                for ip in server.networks[network]:
-                    if re.match('\d+\.\d+\.\d+\.\d+', ip):
-                        return ip
-        except Exception, e:
-            self.log.warning("Could not find ip for request %s: %s", request.name, e)
-            raise e
+        if status != 'ACTIVE':
+            self.log.debug("Headnode for request %s is not active yet.", request.name)
+            return None
 
-        return None
+        ip = self.inventory.ipv4(name)
+        if ip is None:
+            self.log.warning("Could not find ip for request %s", request.name)
+        return ip
 
     def vm_name(self, request):
         return self.node_prefix + request.name
@@ -1,51 +1,156 @@
 #!/usr/bin/env python
-# 
+#
 #
 import json
+import time
 
 from vc3master.task import VC3Task
+from vc3master.certs import CertificateSigner
 from vc3infoservice.infoclient import Pairing, InfoConnectionFailure
 
 class HandlePairingRequests(VC3Task):
     '''
-    Check for requests in /info/pairing to make pairing. 
-    Create keypair, store in /pairing/<pairingcode> category for unvalidated retrieval. 
-     
-    '''    
+    Check for requests in /info/pairing to make pairing.
+    Create keypair, store in /pairing/<pairingcode> category for unvalidated retrieval.
+
+    Certificates are issued in the background by a CertificateSigner, and
+    written back in the first cycle after they are ready (the taskset is
+    triggered when the signer runs out of work).
+
+    Only the entries that got a certificate in this cycle are written back,
+    merged into the document, so that pairings added meanwhile by the portal
+    are kept. Entries are removed pairing_lifetime seconds after their
+    certificate was issued, in a cycle in which no one else changed the
+    document.
+    '''
+    def __init__(self, parent, config, section):
+        super(HandlePairingRequests, self).__init__(parent, config, section)
+
+        # pairing code -> time its certificate was issued (or first seen
+        # issued, for pairings issued before a restart).
+        self.issued = {}
+
+        # pairing code -> (certstr, keystr) issued but not written back yet.
+        self.unwritten = {}
+
+        self.pairing_lifetime = 3600
+        if self.config.has_option(section, 'pairing_lifetime'):
+            self.pairing_lifetime = int(self.config.get(section, 'pairing_lifetime'))
+
+        signers = 1
+        if self.config.has_option(section, 'pairing_signers'):
+            signers = int(self.config.get(section, 'pairing_signers'))
+        self.signer = CertificateSigner(self.parent.parent.ssca, self.metrics, signers, on_idle = self.parent.trigger)
+
+        self.m_issued = self.metrics.counter('vc3_pairing_certificates_total', 'Certificates issued for pairing requests.')
+        self.m_pruned = self.metrics.counter('vc3_pairing_pruned_total', 'Expired pairings removed from the pairing document.')
+
     def runtask(self):
         '''
         '''
         self.log.info("Running task %s" % self.section)
         self.log.debug("Getting 'pairing' doc.")
         self.ic = self.parent.parent.infoclient
-        self.ssca = self.parent.parent.ssca
         try:
-            doc = self.ic.getdocument('pairing')
-            #self.log.debug('Doc is %s' % doc)
-            ds = json.loads(doc)
-            pdoc = ds['pairing']
+            pdoc = self.read_pairings()
             self.log.debug("pairing section in doc. Handling request(s)...")
-            for poname in ds['pairing'].keys():
-                #pd = ds[poname]
-                self.log.debug("Detected pairing request %s" % poname)
-                #po = Pairing.objectFromDict(pd)
-                #self.log.debug("Made pairing object %s" % po)
-                if ds['pairing'][poname]['cert'] is None:                    
-                    (certstr, keystr) = self.ssca.getusercert(ds['pairing'][poname]['cn'])
-                    self.log.debug("Got cert and key strings for %s" % poname )
-                    ecertstr = self.ic.encode(certstr)
-                    ekeystr = self.ic.encode(keystr)
-                    ds['pairing'][poname]['cert'] = ecertstr
-                    ds['pairing'][poname]['key'] = ekeystr  
-            jd = json.dumps(ds)
-            self.ic.storedocument('pairing',jd)
+            self.processed = len(pdoc)
+
+            now = time.time()
+            for poname in pdoc.keys():
+                if pdoc[poname]['cert'] is not None:
+                    self.issued.setdefault(poname, now)
+                    continue
+                if self.unwritten.has_key(poname):
+                    continue
+                if self.signer.submit(poname, pdoc[poname]['cn']):
+                    self.log.debug("Detected pairing request %s" % poname)
+
+            # all certificates issued since the last cycle go in one write.
+            self.unwritten.update(self.signer.collect())
+            changed = {}
+            for (poname, (certstr, keystr)) in self.unwritten.items():
+                self.log.debug("Got cert and key strings for %s" % poname )
+                changed[poname] = { 'cert' : self.ic.encode(certstr), 'key' : self.ic.encode(keystr) }
+
+            if changed:
+                pdoc = self.write_pairings(changed)
+            self.unwritten = {}
+
+            # forget pairings removed by someone else.
+            for poname in self.issued.keys():
+                if not pdoc.has_key(poname):
+                    self.issued.pop(poname, None)
+
+            self.prune_pairings(now, pdoc)
         except InfoConnectionFailure, e:
             self.log.warning("Could not read pairing requests from infoservice. (%s)", e)
         except KeyError:
         # no pairing section
             self.log.debug("No pairing section in doc.")
-        #    ds['pairing'] = {}
-        #    jd = json.dumps(ds)
-        #    self.ic.storedocument('pairing',jd)
 
-                
+    def stop(self):
+        self.signer.stop(5)
+
+    def read_pairings(self):
+        doc = self.ic.getdocument('pairing')
+        ds  = json.loads(doc)
+        return ds['pairing']
+
+    def write_pairings(self, changed):
+        '''
+        Merges the new certificates into the pairing document. The document
+        is read again first, and entries that are gone or that got a
+        certificate meanwhile are not written, so that a stale copy never
+        overwrites a newer one. Returns the document as written.
+        '''
+        current = self.read_pairings()
+
+        entries = {}
+        for (poname, update) in changed.items():
+            entry = current.get(poname, None)
+            if entry is None or entry['cert'] is not None:
+                self.log.debug("Pairing %s changed while its certificate was issued, not writing it." % poname)
+                continue
+            entry = dict(entry)
+            entry.update(update)
+            entries[poname] = entry
+
+        if not entries:
+            return current
+
+        self.ic.mergedocument('pairing', json.dumps({ 'pairing' : entries }))
+        current.update(entries)
+
+        now = time.time()
+        for poname in entries.keys():
+            self.issued[poname] = now
+        self.m_issued.inc(len(entries))
+        self.log.info("Issued certificates for %d pairing request(s)." % len(entries))
+        return current
+
+    def prune_pairings(self, now, expected):
+        '''
+        Removes pairings whose certificate was issued more than
+        pairing_lifetime seconds ago. Deleting needs to store the whole
+        document, which would drop pairings added by the portal since it was
+        read. So the document is read again, and pruning waits for a later
+        cycle unless it is still as expected (as read in this cycle, plus
+        our own writes).
+        '''
+        expired = [p for (p, issued) in self.issued.items() if now - issued > self.pairing_lifetime]
+        if not expired:
+            return
+
+        ds = json.loads(self.ic.getdocument('pairing'))
+        if ds.get('pairing', None) != expected:
+            self.log.debug("Pairing document changed during the cycle, not pruning it now.")
+            return
+
+        for poname in expired:
+            ds['pairing'].pop(poname, None)
+            self.issued.pop(poname, None)
+        self.ic.storedocument('pairing', json.dumps(ds))
+
+        self.m_pruned.inc(len(expired))
+        self.log.info("Removed %d expired pairing(s)." % len(expired))
@@ -6,11 +6,20 @@ from base64 import b64encode
 import socket
 
 import os
+import collections
 import json
+import hashlib
 import math
-from datetime import datetime
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from vc3master.task import VC3Task
+from vc3master.tracking import ChangeTracker, entity_fields
+from vc3master.members import ProjectMembership
+from vc3master.depindex import DependencyIndex
+from vc3master.deadlines import DeadlineIndex
+from vc3master.status import StatusTable
 from vc3infoservice.infoclient import InfoConnectionFailure,InfoEntityMissingException
 
 import pluginmanager as pm
@@ -21,10 +30,65 @@ class HandleRequests(VC3Task):
     Plugin to manage the life cycle of all requests.
      
     '''
+    prefetch = ['Cluster', 'Nodeset', 'Allocation', 'Resource', 'Nodeinfo', 'Environment', 'Project', 'User']
 
     def __init__(self, parent, config, section):
         super(HandleRequests, self).__init__(parent, config, section)
         self.client = parent.client
+        self.tracker = ChangeTracker(self.client, self.metrics, 'HandleRequests')
+        self.members = ProjectMembership(self.client, self.metrics)
+
+        # request name -> (fingerprint, time) of requests whose last
+        # processing did not change them. Requests may be processed by the
+        # request_workers pool, so it is only used under fingerprints_lock.
+        self.fingerprints      = {}
+        self.fingerprints_lock = threading.Lock()
+
+        # process unchanged requests anyway after this many seconds.
+        self.fingerprint_max_age = 600
+        if self.config.has_option(section, 'fingerprint_max_age'):
+            self.fingerprint_max_age = int(self.config.get(section, 'fingerprint_max_age'))
+
+        # number of requests processed concurrently. With 1, requests are
+        # processed one after the other in the taskset thread.
+        self.request_workers = 1
+        if self.config.has_option(section, 'request_workers'):
+            self.request_workers = int(self.config.get(section, 'request_workers'))
+
+        self.pool = None
+        if self.request_workers > 1:
+            self.pool = ThreadPool(self.request_workers)
+
+        self.m_unchanged = self.metrics.counter('vc3_requests_unchanged_total', 'Requests skipped because their inputs did not change.')
+
+        # which requests read which entities, so that a change to an entity
+        # only sends its dependents through the state machine again.
+        self.depindex = DependencyIndex(self.metrics)
+        self.parent.parent.clientcache.add_listener(self.depindex.invalidate)
+
+        # entities changed by others are only compared field by field every
+        # this many seconds (by default, every cycle); in between only
+        # additions and removals are seen.
+        self.dependency_check_interval = parent.polling_interval
+        if self.config.has_option(section, 'dependency_check_interval'):
+            self.dependency_check_interval = int(self.config.get(section, 'dependency_check_interval'))
+        self.last_dependency_check = 0
+        self.dependency_listing_failed = False
+
+        # request name -> expiration time, parsed once per expiration value.
+        # The taskset is woken when the next one passes.
+        self.expirations = DeadlineIndex()
+
+        # job counts from the statusraw of each request, with running totals
+        # per nodeset and per request.
+        self.status = StatusTable()
+
+        # encoded queues.conf and auth.conf, keyed by the digest of their inputs.
+        self.conf_cache      = collections.OrderedDict()
+        self.conf_cache_size = 1024
+        self.conf_lock       = threading.Lock()
+        self.m_conf_hits     = self.metrics.counter('vc3_conf_cache_hits_total', 'queues.conf/auth.conf reused from the cache.')
+        self.m_conf_misses   = self.metrics.counter('vc3_conf_cache_misses_total', 'queues.conf/auth.conf generated.')
         self.log.debug("HandleRequests VC3Task initialized.")
 
     def runtask(self):
@@ -32,32 +96,234 @@ class HandleRequests(VC3Task):
         self.log.debug("Polling master....")
 
         try:
-            requests = self.client.listRequests()
-            n = len(requests) if requests else 0
+            # we write whole requests back, so we start from a fresh listing:
+            # changes made by the portal or the factories since an older one
+            # would be overwritten. The snapshot we publish is reused by the
+            # plugins that only read requests.
+            snapshot = self.parent.parent.snapshots.current(max_age = 0)
+            requests = snapshot.requests()
+            n = len(requests)
             self.log.debug("Processing %d requests" % n)
-            if requests:
-                for r in requests:
-                    try:
-                        self.process_request(r)
-                    except VC3InvalidRequest, e:
-                        self.log.warning("Request %s is not valid. (%s)", r.name, e)
-                        r.state = 'failure'
-                        r.state_reason = 'Request invalid: ' + str(e)
-                    except Exception, e:
-                        self.log.warning("Request %s had a exception (%s)", r.name, e)
-                        self.log.debug(traceback.format_exc(None))
-                        r.state = 'failure'
-                        r.state_reason = str(e)
-
-                    try:
-                        self.client.storeRequest(r)
-                    except Exception, e:
-                        self.log.warning("Storing the new request state failed. (%s)", e)
-                        self.log.warning(traceback.format_exc(None))
+            self.tracker.clear()
+            self.refresh_dependencies()
+
+            if self.pool and len(requests) > 1:
+                results = self.pool.map(self.handle_request_isolated, requests)
+            else:
+                results = [self.handle_request_isolated(r) for r in requests]
+
+            processed = len([x for x in results if x])
+            self.processed = processed
+            self.log.debug("%d requests processed, %d unchanged." % (processed, n - processed))
+
+            self.forget_fingerprints([r.name for r in requests])
+            self.members.prune()
+
+            expiration = self.expirations.next_deadline()
+            if expiration is not None:
+                # one second late, as expirations have a resolution of seconds.
+                self.parent.trigger(expiration + 1)
 
         except InfoConnectionFailure, e:
             self.log.warning("Could not read requests from infoservice. (%s)", e)
 
+    def stop(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def handle_request_isolated(self, r):
+        '''
+        Like handle_request, but an unexpected error only affects request r.
+        '''
+        try:
+            return self.handle_request(r)
+        except Exception, e:
+            self.log.warning("Request %s had a exception (%s)", r.name, e)
+            self.log.debug(traceback.format_exc(None))
+            return True
+
+    def handle_request(self, r):
+        '''
+        Runs the state machine of request r and stores it if it changed.
+        Returns False if r was skipped because none of its inputs changed.
+        '''
+        fingerprint = self.request_fingerprint(r)
+        if self.is_unchanged(r, fingerprint):
+            self.m_unchanged.inc()
+            return False
+
+        self.tracker.track(r)
+        try:
+            self.process_request(r)
+        except VC3InvalidRequest, e:
+            self.log.warning("Request %s is not valid. (%s)", r.name, e)
+            r.state = 'failure'
+            r.state_reason = 'Request invalid: ' + str(e)
+        except Exception, e:
+            self.log.warning("Request %s had a exception (%s)", r.name, e)
+            self.log.debug(traceback.format_exc(None))
+            r.state = 'failure'
+            r.state_reason = str(e)
+
+        try:
+            self.tracker.store(r)
+        except Exception, e:
+            self.log.warning("Storing the new request state failed. (%s)", e)
+            self.log.warning(traceback.format_exc(None))
+            fingerprint = None
+
+        self.remember_fingerprint(r, fingerprint)
+        return True
+
+    def request_fingerprint(self, request):
+        '''
+        Digest of the request and of its headnode, the inputs that change
+        without being listed in the dependency index. Returns None if they
+        cannot be read, so that the request is processed (and the error
+        reported) as usual.
+        '''
+        try:
+            inputs = {}
+            inputs['request']  = entity_fields(request)
+            inputs['headnode'] = None
+
+            headnode = self.getHeadNode(request)
+            if headnode:
+                inputs['headnode'] = entity_fields(headnode)
+
+            return self.digest(inputs)
+        except Exception, e:
+            self.log.debug("Could not compute fingerprint of request %s (%s)", request.name, e)
+            return None
+
+    def request_dependencies(self, request):
+        '''
+        (kind, name) of every entity the processing of request reads: the
+        cluster, nodesets, allocations, resources, node sizes, environments
+        and project. Returns None if any of them cannot be read.
+        '''
+        try:
+            deps = set()
+            env_names = list(request.environments or [])
+
+            deps.add(('cluster', request.cluster))
+            cluster = self.client.getCluster(request.cluster)
+            for nodeset_name in cluster.nodesets:
+                deps.add(('nodeset', nodeset_name))
+                nodeset = self.client.getNodeset(nodeset_name)
+                if nodeset.environment is not None:
+                    env_names.append(nodeset.environment)
+
+            for allocation_name in (request.allocations or []):
+                deps.add(('allocation', allocation_name))
+                allocation = self.client.getAllocation(allocation_name)
+                deps.add(('resource', allocation.resource))
+                resource   = self.client.getResource(allocation.resource)
+                deps.add(('nodeinfo', resource.nodeinfo))
+
+            for env_name in env_names:
+                deps.add(('environment', env_name))
+
+            if request.project:
+                deps.add(('project', request.project))
+
+            return deps
+        except Exception, e:
+            self.log.debug("Could not find dependencies of request %s (%s)", request.name, e)
+            return None
+
+    def refresh_dependencies(self):
+        '''
+        Marks dirty the requests that depend on entities changed since the
+        last cycle. The listings come from the cycle cache.
+        '''
+        try:
+            listings = {}
+            for kind in ['Cluster', 'Nodeset', 'Allocation', 'Resource', 'Nodeinfo', 'Environment', 'Project']:
+                listings[kind.lower()] = getattr(self.client, 'list%ss' % kind)()
+
+            now  = time.time()
+            full = now - self.last_dependency_check >= self.dependency_check_interval
+            self.depindex.refresh(listings, full)
+            if full:
+                self.last_dependency_check = now
+            if self.dependency_listing_failed:
+                self.log.info("Listing entities to find changes works again.")
+                self.dependency_listing_failed = False
+        except Exception, e:
+            # without the listings we cannot tell, so everything is dirty.
+            if not self.dependency_listing_failed:
+                self.log.warning("Could not list entities to find changes, processing all requests until it works again (%s)", e)
+                self.dependency_listing_failed = True
+            else:
+                self.log.debug("Could not list entities to find changes (%s)", e)
+            for name in self.depindex.known_requests():
+                self.depindex.remove(name)
+
+    def digest(self, inputs):
+        return hashlib.sha1(json.dumps(inputs, sort_keys = True, default = str)).hexdigest()
+
+    def is_unchanged(self, request, fingerprint):
+        '''
+        True if request was left as it was by its last processing, its inputs
+        have not changed since, and no time based transition is due.
+        '''
+        if fingerprint is None:
+            return False
+
+        with self.fingerprints_lock:
+            (previous, when) = self.fingerprints.get(request.name, (None, None))
+        if previous != fingerprint:
+            return False
+
+        if self.depindex.is_dirty(request.name):
+            return False
+
+        if time.time() - when > self.fingerprint_max_age:
+            return False
+
+        try:
+            if not self.is_finishing_state(request.state) and self.request_has_expired(request):
+                return False
+        except Exception:
+            return False
+
+        return True
+
+    def remember_fingerprint(self, request, fingerprint):
+        '''
+        Only a processing that did not modify the request is a fixed point of
+        the state machine. Otherwise, the next cycle processes the request
+        again with its new state.
+        '''
+        deps = None
+        if fingerprint is not None and self.request_fingerprint(request) == fingerprint:
+            deps = self.request_dependencies(request)
+
+        with self.fingerprints_lock:
+            if deps is not None:
+                self.fingerprints[request.name] = (fingerprint, time.time())
+            else:
+                self.fingerprints.pop(request.name, None)
+
+        if deps is not None:
+            self.depindex.set_dependencies(request.name, deps)
+        else:
+            self.depindex.remove(request.name)
+
+    def forget_fingerprints(self, names):
+        with self.fingerprints_lock:
+            for name in set(self.fingerprints.keys()) - set(names):
+                self.fingerprints.pop(name, None)
+        for name in set(self.depindex.known_requests()) - set(names):
+            self.depindex.remove(name)
+        for name in set(self.expirations.keys()) - set(names):
+            self.expirations.remove(name)
+        for name in set(self.status.keys()) - set(names):
+            self.status.remove(name)
+
     def process_request(self, request):
         next_state  = None
         reason      = None
@@ -79,7 +345,7 @@ class HandleRequests(VC3Task):
                 (next_state, reason) = ('terminating', 'received terminate action')
 
         nodesets           = self.getNodesets(request)
-        request.statusinfo = self.compute_job_status_summary(request.statusraw, nodesets, next_state)
+        request.statusinfo = self.compute_job_status_summary(request, nodesets, next_state)
 
         if next_state == 'terminated':
             (next_state, reason) = self.state_terminated(request)
@@ -162,15 +428,14 @@ class HandleRequests(VC3Task):
                     if project.members and len(project.members) > 0:
                         if request.owner not in project.members:
                             bad_reasons.append("User '%s' that created the virtual cluster does not belong to project '%s'." % (request.owner, request.project))
+                        membership = self.members.resolve(project)
                         for member_name in project.members:
-                            try:
-                                member = self.client.getUser(member_name)
-                                if not member.sshpubstring:
-                                    bad_reasons.append("User '%s' in project '%s' does not have a ssh-key." % (member_name, request.project))
-                                elif not self.client.validate_ssh_pub_key(member.sshpubstring):
-                                    bad_reasons.append("User '%s' in project '%s' has an invalid ssh-key." % (member_name, request.project))
-                            except InfoEntityMissingException:
+                            if member_name in membership.missing:
                                 bad_reasons.append("User '%s' in project '%s' is not defined." % (member_name, request.project))
+                            elif not membership.users[member_name]['sshpubstring']:
+                                bad_reasons.append("User '%s' in project '%s' does not have a ssh-key." % (member_name, request.project))
+                            elif not membership.has_valid_key(member_name):
+                                bad_reasons.append("User '%s' in project '%s' has an invalid ssh-key." % (member_name, request.project))
                     else:
                         bad_reasons.append("Project '%s' did not define any members." % (request.project,))
                 except InfoEntityMissingException:
@@ -284,6 +549,13 @@ class HandleRequests(VC3Task):
                    .cluster.nodesets = [ nodeset1, nodeset2 ]                                       
              nodeset.node_number   # total number to launch. 
         '''
+        digest = self.queues_conf_digest(request, nodesets)
+        cached = self.cached_conf(digest)
+        if cached is not None:
+            if request.queuesconf != cached:
+                request.queuesconf = cached
+            return request.queuesconf
+
         config = ConfigParser.RawConfigParser()
 
         try:
@@ -294,6 +566,7 @@ class HandleRequests(VC3Task):
             config.write(conf_as_string)
 
             request.queuesconf = b64encode(conf_as_string.getvalue())
+            self.remember_conf(digest, request.queuesconf)
             return request.queuesconf
         except Exception, e:
             self.log.error('Failure to generate queuesconf: %s', e)
@@ -302,6 +575,13 @@ class HandleRequests(VC3Task):
             raise e
 
     def add_auth_conf(self, request):
+        digest = self.auth_conf_digest(request)
+        cached = self.cached_conf(digest)
+        if cached is not None:
+            if request.authconf != cached:
+                request.authconf = cached
+            return request.authconf
+
         config = ConfigParser.RawConfigParser()
 
         try:
@@ -312,12 +592,87 @@ class HandleRequests(VC3Task):
             config.write(conf_as_string)
 
             request.authconf = b64encode(conf_as_string.getvalue())
+            self.remember_conf(digest, request.authconf)
             return request.authconf
         except Exception, e:
             self.log.error('Failure generating auth.conf: %s', e)
             request.authconf = None
             return None
 
+    def queues_conf_digest(self, request, nodesets):
+        '''
+        Digest of every input of add_queues_conf. Returns None if some input
+        cannot be read, in which case the conf is generated as usual.
+        '''
+        try:
+            inputs = {}
+            inputs['kind']         = 'queues'
+            inputs['request']      = [request.name, request.allocations, request.environments, request.headnode]
+            inputs['nodesets']     = [entity_fields(n) for n in nodesets]
+            inputs['allocations']  = []
+            inputs['environments'] = []
+            inputs['headnode']     = None
+
+            for allocation_name in request.allocations:
+                allocation = self.client.getAllocation(allocation_name)
+                resource   = self.client.getResource(allocation.resource)
+                nodeinfo   = self.client.getNodeinfo(resource.nodeinfo)
+                to_run     = [self.jobs_to_run_by_policy(request, allocation, n) for n in nodesets]
+                inputs['allocations'].append([entity_fields(allocation), entity_fields(resource), entity_fields(nodeinfo), to_run])
+
+            env_names = list(request.environments or [])
+            env_names.extend([n.environment for n in nodesets if n.environment is not None])
+            for env_name in env_names:
+                environment = self.client.getEnvironment(env_name)
+                inputs['environments'].append(environment and entity_fields(environment))
+
+            headnode = self.getHeadNode(request)
+            if headnode:
+                inputs['headnode'] = [headnode.app_host, headnode.app_sectoken]
+
+            return self.digest(inputs)
+        except Exception, e:
+            self.log.debug("Could not compute queues.conf digest for request %s (%s)", request.name, e)
+            return None
+
+    def auth_conf_digest(self, request):
+        try:
+            inputs = {}
+            inputs['kind']        = 'auth'
+            inputs['allocations'] = []
+            for allocation_name in request.allocations:
+                allocation = self.client.getAllocation(allocation_name)
+                resource   = self.client.getResource(allocation.resource)
+                inputs['allocations'].append([entity_fields(allocation), entity_fields(resource)])
+            return self.digest(inputs)
+        except Exception, e:
+            self.log.debug("Could not compute auth.conf digest for request %s (%s)", request.name, e)
+            return None
+
+    def cached_conf(self, digest):
+        if digest is None:
+            return None
+
+        with self.conf_lock:
+            encoded = self.conf_cache.pop(digest, None)
+            if encoded is not None:
+                # most recently used go last
+                self.conf_cache[digest] = encoded
+        if encoded is not None:
+            self.m_conf_hits.inc()
+        else:
+            self.m_conf_misses.inc()
+        return encoded
+
+    def remember_conf(self, digest, encoded):
+        if digest is None:
+            return
+
+        with self.conf_lock:
+            self.conf_cache[digest] = encoded
+            while len(self.conf_cache) > self.conf_cache_size:
+                self.conf_cache.popitem(last = False)
+
     def generate_queues_section(self, config, request, nodesets, allocation_name):
         allocation = self.client.getAllocation(allocation_name)
         if not allocation:
@@ -679,19 +1034,11 @@ class HandleRequests(VC3Task):
         if not self.is_configuring_state(request.state):
             return None
 
-        at_least_one_nodeset = False
-        count = 0
-
-        for nodeset in request.statusinfo.keys():
-            count += request.statusinfo[nodeset].get(state, 0)
-            at_least_one_nodeset = True
-
-        if at_least_one_nodeset:
-            self.log.debug('Counting %d jobs in state %s for request %s', count, state, request.name)
-            return count
+        # statusinfo has the same nodesets the totals were computed over.
+        count = self.status.request_totals(request.name).get(state, 0)
 
-        self.log.debug('No nodesets with jobs in state %s for request %s', state, request.name)
-        return None
+        self.log.debug('Counting %d jobs in state %s for request %s', count, state, request.name)
+        return count
 
 
     def total_jobs_requested(self, request):
@@ -712,19 +1059,20 @@ class HandleRequests(VC3Task):
                 total_jobs += nodeset.node_number
         return total_jobs
 
-    def compute_job_status_summary(self, statusraw, nodesets, next_state):
-        if not statusraw:
+    def compute_job_status_summary(self, request, nodesets, next_state):
+        if not request.statusraw:
+            self.status.remove(request.name)
             return None
 
         if self.is_initializing_state(next_state):
+            self.status.remove(request.name)
             return None
 
+        self.status.update(request.name, request.statusraw, [nodeset.name for nodeset in nodesets])
+
         statusinfo = {}
         for nodeset in nodesets:
-            statusinfo[nodeset.name]                 = {}
-            statusinfo[nodeset.name]['running']      = 0
-            statusinfo[nodeset.name]['idle']         = 0
-            statusinfo[nodeset.name]['error']       = 0
+            statusinfo[nodeset.name]                = self.status.nodeset_totals(request.name, nodeset.name)
             statusinfo[nodeset.name]['node_number'] = nodeset.node_number
 
             if self.is_finishing_state(next_state):
@@ -732,17 +1080,6 @@ class HandleRequests(VC3Task):
             else:
                 statusinfo[nodeset.name]['requested'] = statusinfo[nodeset.name]['node_number']
 
-            try:
-                for factory in statusraw.keys():
-                    for allocation in statusraw[factory][nodeset.name].keys():
-                        try:
-                            for field in ['running', 'idle', 'error']:
-                                statusinfo[nodeset.name][field] += statusraw[factory][nodeset.name][allocation]['aggregated'][field]
-                        except KeyError, e:
-                            pass
-            except KeyError, e:
-                pass
-
         return statusinfo
 
     def getHeadNode(self, request):
@@ -774,11 +1111,11 @@ class HandleRequests(VC3Task):
         return nodesets
 
     def request_has_expired(self, request):
-        if request.expiration is None:
+        limit = self.expirations.deadline(request.name, request.expiration)
+        if limit is None:
             return False
-        limit = datetime.strptime(request.expiration, '%Y-%m-%dT%H:%M:%S')
 
-        if limit < datetime.utcnow().replace(microsecond=0):
+        if limit < int(time.time()):
             self.log.debug("Request %s has expired.", request.name)
             return True
 
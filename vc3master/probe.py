@@ -0,0 +1,139 @@
+#
+# Concurrent liveness probes of hosts reachable through ssh.
+#
+
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+
+def tcp_connect(host, port, timeout):
+    '''
+    True if a TCP connection to host:port can be opened within timeout
+    seconds.
+    '''
+    try:
+        s = socket.create_connection((host, int(port)), timeout)
+        s.close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+def run_with_deadline(argv, deadline, env = None):
+    '''
+    Runs argv, killing it if it is still running after deadline seconds.
+    Returns its exit status, or None if it was killed.
+    '''
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(argv, stdin = devnull, stdout = devnull, stderr = devnull, env = env)
+
+    expired = []
+    def kill():
+        expired.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+    timer = threading.Timer(deadline, kill)
+    timer.start()
+    try:
+        returncode = proc.wait()
+    finally:
+        timer.cancel()
+
+    if expired:
+        return None
+    return returncode
+
+
+class ProbeEngine(object):
+    '''
+    Checks whether hosts accept an ssh login, running up to max_concurrency
+    probes at a time, each limited to deadline seconds. A TCP connect to the
+    ssh port is tried first, so that unreachable hosts fail fast. Results are
+    kept until the next begin_cycle(). With an SSHControlPool, probes of the
+    same host reuse its master connection.
+    '''
+    def __init__(self, metrics, max_concurrency = 16, deadline = 15, port = 22, sshpool = None):
+        self.log      = logging.getLogger()
+        self.deadline = deadline
+        self.port     = port
+        self.sshpool  = sshpool
+        self.pool     = ThreadPool(max_concurrency)
+        self.lock     = threading.Lock()
+        self.results  = {}
+
+        self.m_probes   = metrics.counter('vc3_ssh_probes_total', 'ssh liveness probes run, by result.')
+        self.m_duration = metrics.histogram('vc3_ssh_probe_seconds', 'Duration of ssh liveness probes.')
+
+    def begin_cycle(self):
+        with self.lock:
+            self.results = {}
+
+    def probe_all(self, targets):
+        '''
+        Probes all targets, (host, user, keyfile) tuples, concurrently.
+        '''
+        with self.lock:
+            pending = [t for t in set(targets) if t not in self.results]
+        if not pending:
+            return
+
+        start = time.time()
+        self.pool.map(self.probe, pending)
+        self.log.debug("Probed %d hosts in %.1f seconds." % (len(pending), time.time() - start))
+
+    def is_alive(self, host, user, keyfile):
+        '''
+        Result of the probe of (host, user, keyfile) in this cycle, probing
+        it now if it was not probed yet.
+        '''
+        target = (host, user, keyfile)
+        with self.lock:
+            if target in self.results:
+                return self.results[target]
+        return self.probe(target)
+
+    def probe(self, target):
+        (host, user, keyfile) = target
+        start = time.time()
+
+        multiplexed = self.sshpool and self.sshpool.is_active(host, self.port, user, keyfile)
+
+        alive = multiplexed or tcp_connect(host, self.port, min(self.deadline, 10))
+        if alive:
+            returncode = run_with_deadline(self.ssh_command(host, user, keyfile), self.deadline)
+            alive = (returncode == 0)
+            if self.sshpool:
+                self.sshpool.report(host, self.port, user, keyfile, alive)
+
+        self.m_duration.observe(time.time() - start)
+        self.m_probes.inc(result = alive and 'alive' or 'unreachable')
+
+        with self.lock:
+            self.results[target] = alive
+        return alive
+
+    def ssh_command(self, host, user, keyfile):
+        mux = []
+        if self.sshpool:
+            mux = self.sshpool.options(host, self.port, user, keyfile)
+
+        return ['ssh'] + mux + [
+                '-o', 'UserKnownHostsFile=/dev/null',
+                '-o', 'StrictHostKeyChecking=no',
+                '-o', 'BatchMode=yes',
+                '-o', 'ConnectTimeout=%d' % min(self.deadline, 10),
+                '-i', keyfile,
+                '-l', user,
+                '-p', str(self.port),
+                host,
+                '--',
+                '/bin/date']
+
@@ -0,0 +1,435 @@
+#
+# Bounded executor for provisioning commands (ansible-playbook runs).
+#
+
+import errno
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# one line per host of the PLAY RECAP at the end of an ansible-playbook run.
+RECAP_RE = re.compile(r'^(\S+)\s*:\s*ok=\d+\s+changed=\d+\s+unreachable=(\d+)\s+failed=(\d+)')
+
+def parse_recap(logfile):
+    '''
+    Per host exit status from the PLAY RECAP of an ansible-playbook log: 0
+    if the host was fine, 2 if a task failed on it, 4 if it was unreachable
+    (as ansible-playbook itself reports).
+    '''
+    results = {}
+    try:
+        with open(logfile) as f:
+            for line in f:
+                m = RECAP_RE.match(line.strip())
+                if m is None:
+                    continue
+                (host, unreachable, failed) = (m.group(1), int(m.group(2)), int(m.group(3)))
+                if unreachable > 0:
+                    results[host] = 4
+                elif failed > 0:
+                    results[host] = 2
+                else:
+                    results[host] = 0
+    except IOError:
+        pass
+    return results
+
+
+def process_identity(pid):
+    '''
+    boot id and start time (in clock ticks since boot) of process pid, which
+    together tell it apart from a later process that reuses the pid. None if
+    they cannot be read.
+    '''
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+        # the command name, in parentheses, may contain spaces; starttime is
+        # field 22, the 20th after it.
+        starttime = stat[stat.rindex(')') + 2:].split()[19]
+        return '%s:%s' % (boot_id, starttime)
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class ProvisionJob(object):
+    '''
+    One provisioning command. returncode is None until the command finishes.
+    files are removed when the job is popped or cancelled.
+    '''
+    def __init__(self, key, priority, argv, cwd, env, logfile, files = None):
+        self.key        = key
+        self.priority   = priority
+        self.argv       = argv
+        self.cwd        = cwd
+        self.env        = env
+        self.logfile    = logfile
+        self.files      = files or []
+        self.proc       = None
+        self.pid        = None
+        self.identity   = None
+        self.returncode = None
+        self.submitted  = time.time()
+        self.started    = None
+        self.finished   = None
+        self.recap      = None
+
+    def is_queued(self):
+        return self.started is None and self.returncode is None
+
+    def is_running(self):
+        return self.started is not None and self.returncode is None
+
+    def is_done(self):
+        return self.returncode is not None
+
+    @property
+    def rcfile(self):
+        return self.logfile + '.rc'
+
+    def host_returncode(self, host):
+        '''
+        Exit status of a done job for one of its hosts, from the PLAY RECAP
+        in its log, or the status of the whole run if host is not there.
+        '''
+        if not self.is_done():
+            return None
+        if self.recap is None:
+            self.recap = parse_recap(self.logfile)
+        return self.recap.get(host, self.returncode)
+
+
+class ProvisionBatch(object):
+    '''
+    Hosts to be configured by a single run of the same playbook, each with
+    its own variables. job is None until the batch is submitted.
+    '''
+    def __init__(self, key, playbook):
+        self.key      = key
+        self.playbook = playbook
+        self.hosts    = OrderedDict()
+        self.priority = None
+        self.job      = None
+
+    def add(self, host, hostvars, priority):
+        self.hosts[host] = hostvars
+        if self.priority is None or priority < self.priority:
+            self.priority = priority
+        return HostJob(self, host)
+
+    def write_inventory(self, path):
+        '''
+        Writes an inventory with the hosts of the batch and their variables.
+        JSON is valid YAML, so ansible reads it with its yaml inventory.
+        '''
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({ 'all' : { 'hosts' : self.hosts } }, f, indent = 2)
+        return path
+
+
+class HostJob(object):
+    '''
+    The part of a ProvisionBatch concerning one host. Looks like a
+    ProvisionJob, with returncode the status of the run for that host.
+    '''
+    def __init__(self, batch, host):
+        self.batch = batch
+        self.host  = host
+
+    @property
+    def key(self):
+        return self.batch.key
+
+    @property
+    def logfile(self):
+        return self.batch.job and self.batch.job.logfile
+
+    @property
+    def started(self):
+        return self.batch.job and self.batch.job.started
+
+    @property
+    def finished(self):
+        return self.batch.job and self.batch.job.finished
+
+    @property
+    def returncode(self):
+        if self.batch.job is None:
+            return None
+        return self.batch.job.host_returncode(self.host)
+
+    def is_queued(self):
+        return self.batch.job is None or self.batch.job.is_queued()
+
+
+class ProvisionExecutor(object):
+    '''
+    Runs at most max_running jobs at a time. Queued jobs start in order of
+    priority, lowest first, so using the submission time of the oldest
+    attempt as priority serves requests by age. Each run writes its output
+    to its own file in logdir.
+
+    Jobs run in their own session, and write their exit status next to their
+    log file, so that they outlive a restart of the master and can be
+    adopted by the next one. An adopted job is only considered running while
+    its pid still belongs to the process that was started (see
+    process_identity), and for at most max_adopted_age seconds after it was
+    started; then it is killed and fails.
+
+    Log files (and exit status files) in logdir older than max_log_age
+    seconds are removed, at most once an hour, when a job is popped.
+    '''
+    def __init__(self, metrics, max_running, logdir, max_adopted_age = None, max_log_age = None):
+        self.log         = logging.getLogger()
+        self.max_running = max_running
+        self.logdir      = logdir
+        self.max_adopted_age = max_adopted_age
+        self.max_log_age     = max_log_age
+        self.last_expire     = 0
+        self.lock        = threading.Lock()
+        self.jobs        = {}
+        self.queue       = []
+        self.counter     = itertools.count()
+
+        if not os.path.isdir(self.logdir):
+            os.makedirs(self.logdir)
+
+        self.m_queued   = metrics.gauge('vc3_provision_queue_depth', 'Provisioning jobs waiting to start.')
+        self.m_running  = metrics.gauge('vc3_provision_running', 'Provisioning jobs running.')
+        self.m_wait     = metrics.histogram('vc3_provision_wait_seconds', 'Time provisioning jobs spent queued.')
+        self.m_duration = metrics.histogram('vc3_provision_run_seconds', 'Duration of provisioning runs, by result.')
+
+    def submit(self, key, priority, argv, cwd, env = None, files = None):
+        '''
+        Queues argv to run in cwd. If a job for key is already queued or
+        running, that job is returned instead. files are removed once the
+        job is popped or cancelled.
+        '''
+        with self.lock:
+            job = self.jobs.get(key, None)
+            if job and not job.is_done():
+                return job
+
+            stamp   = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+            logfile = os.path.join(self.logdir, '%s-%s.log' % (key, stamp))
+            job     = ProvisionJob(key, priority, argv, cwd, env, logfile, files)
+
+            self.jobs[key] = job
+            heapq.heappush(self.queue, (priority, self.counter.next(), job))
+            self.log.debug("Queued provisioning job %s (%d queued)." % (key, len(self.queue)))
+        self.poll()
+        return job
+
+    def adopt(self, key, priority, pid, logfile, identity = None, started = None, files = None):
+        '''
+        Takes over a job started by a previous master at started, as process
+        pid logging to logfile. identity is the process_identity of pid
+        recorded when the job was started, if known.
+        '''
+        with self.lock:
+            job = self.jobs.get(key, None)
+            if job and job.pid == pid:
+                return job
+
+            job = ProvisionJob(key, priority, None, None, None, logfile, files)
+            job.pid      = pid
+            job.identity = identity
+            job.started  = started or time.time()
+            self.jobs[key] = job
+            self.log.info("Adopted provisioning job %s (pid %d)." % (key, pid))
+        self.poll()
+        return job
+
+    def job(self, key):
+        with self.lock:
+            return self.jobs.get(key, None)
+
+    def pop(self, key):
+        '''
+        Forgets the job for key, if it is done, and returns it.
+        '''
+        with self.lock:
+            job = self.jobs.get(key, None)
+            if job and job.is_done():
+                job = self.jobs.pop(key)
+            else:
+                job = None
+        if job is not None:
+            self._remove_files(job)
+            self.expire_logs()
+        return job
+
+    def _remove_files(self, job):
+        for path in job.files:
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    self.log.warning("Could not remove %s of provisioning job %s (%s)", path, job.key, e)
+
+    def expire_logs(self, now = None):
+        '''
+        Removes the logs and exit status files of runs older than
+        max_log_age seconds, other than those of known jobs.
+        '''
+        if self.max_log_age is None:
+            return
+        if now is None:
+            now = time.time()
+        if now - self.last_expire < 3600:
+            return
+        self.last_expire = now
+
+        with self.lock:
+            keep = set()
+            for job in self.jobs.values():
+                keep.add(job.logfile)
+                keep.add(job.rcfile)
+
+        removed = 0
+        for name in os.listdir(self.logdir):
+            path = os.path.join(self.logdir, name)
+            if path in keep or not (name.endswith('.log') or name.endswith('.log.rc')):
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.max_log_age:
+                    os.remove(path)
+                    removed += 1
+            except OSError, e:
+                self.log.debug("Could not expire %s (%s)", path, e)
+        if removed:
+            self.log.info("Removed %d provisioning logs older than %d seconds." % (removed, self.max_log_age))
+
+    def position(self, key):
+        '''
+        Number of queued jobs that will start before the job for key.
+        '''
+        with self.lock:
+            job = self.jobs.get(key, None)
+            if job is None or not job.is_queued():
+                return 0
+            return len([j for (p, c, j) in self.queue if (j.priority, j.submitted) < (job.priority, job.submitted) and j.is_queued()])
+
+    def cancel(self, key):
+        '''
+        Removes the job for key from the queue, or kills it if it is running.
+        '''
+        with self.lock:
+            job = self.jobs.pop(key, None)
+        if job is None:
+            self.log.warning("No provisioning job %s to cancel." % key)
+            return
+        self._remove_files(job)
+        if job.is_running():
+            try:
+                # the whole session, so that ansible's own children go too.
+                os.killpg(job.pid, signal.SIGTERM)
+            except OSError, e:
+                self.log.warning("Could not terminate provisioning job %s (%s)", key, e)
+        # queued jobs are dropped from the heap when they reach the top.
+        job.returncode = -1
+        self.poll()
+
+    def poll(self):
+        '''
+        Reaps finished jobs and starts queued ones while there is room.
+        '''
+        with self.lock:
+            running = 0
+            for job in self.jobs.values():
+                if job.is_running():
+                    if self._alive(job):
+                        running += 1
+                    else:
+                        self._finished(job)
+
+            while self.queue and running < self.max_running:
+                (priority, count, job) = heapq.heappop(self.queue)
+                if not job.is_queued():
+                    continue
+                self._start(job)
+                if job.is_running():
+                    running += 1
+
+            self.m_queued.set(len([j for (p, c, j) in self.queue if j.is_queued()]))
+            self.m_running.set(running)
+
+    def _alive(self, job):
+        if job.proc is not None:
+            return job.proc.poll() is None
+        # adopted jobs are not our children, so we can only look for the
+        # process, and for the exit status it leaves when done.
+        if os.path.exists(job.rcfile):
+            return False
+        if not self._is_same_process(job):
+            self.log.warning("Process %d of adopted provisioning job %s is gone." % (job.pid, job.key))
+            return False
+        if self.max_adopted_age is not None and time.time() - job.started > self.max_adopted_age:
+            self.log.warning("Adopted provisioning job %s has run for more than %d seconds, terminating it." % (job.key, self.max_adopted_age))
+            try:
+                os.killpg(job.pid, signal.SIGTERM)
+            except OSError, e:
+                self.log.warning("Could not terminate provisioning job %s (%s)", job.key, e)
+            return False
+        return True
+
+    def _is_same_process(self, job):
+        try:
+            os.kill(job.pid, 0)
+        except OSError, e:
+            if e.errno != errno.EPERM:
+                return False
+        if job.identity is not None:
+            return process_identity(job.pid) == job.identity
+        # without a recorded identity, our jobs lead their own session.
+        try:
+            return os.getsid(job.pid) == job.pid
+        except OSError:
+            return False
+
+    def _start(self, job):
+        job.started = time.time()
+        self.m_wait.observe(job.started - job.submitted)
+
+        # sh writes the exit status of argv to rcfile ($0).
+        argv = ['sh', '-c', '"$@"; rc=$?; echo $rc > "$0"; exit $rc', job.rcfile] + job.argv
+        try:
+            with open(job.logfile, 'a') as log:
+                job.proc = subprocess.Popen(argv, cwd = job.cwd, env = job.env, stdout = log, stderr = subprocess.STDOUT, preexec_fn = os.setsid)
+            job.pid      = job.proc.pid
+            job.identity = process_identity(job.pid)
+            self.log.debug("Started provisioning job %s, logging to %s" % (job.key, job.logfile))
+        except Exception, e:
+            self.log.warning("Could not start provisioning job %s (%s)", job.key, e)
+            job.returncode = -1
+            job.finished   = time.time()
+
+    def _finished(self, job):
+        if job.proc is not None:
+            job.returncode = job.proc.returncode
+        else:
+            job.returncode = self._read_rcfile(job)
+        job.finished   = time.time()
+        self.m_duration.observe(job.finished - job.started, result = (job.returncode == 0) and 'success' or 'failure')
+        self.log.debug("Provisioning job %s finished with status %d." % (job.key, job.returncode))
+
+    def _read_rcfile(self, job):
+        try:
+            with open(job.rcfile) as f:
+                return int(f.read().strip())
+        except (IOError, ValueError), e:
+            self.log.warning("Provisioning job %s exited without status (%s)", job.key, e)
+            return -1
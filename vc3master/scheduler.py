@@ -0,0 +1,164 @@
+#
+# Central deadline scheduler for the taskset threads.
+#
+
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+
+
+class VC3Scheduler(threading.Thread):
+    '''
+    Keeps the next run deadline of every VC3TaskSet in a single heap, and
+    wakes each taskset when its deadline is reached. Tasksets block on their
+    run event without a timeout, so only this thread ever sleeps on a clock.
+
+    The scheduler sleeps in select() on a pipe, with the time left to the
+    earliest deadline as timeout. (On python 2 a Condition.wait with a
+    timeout polls every few milliseconds.) A deadline earlier than the one
+    being slept on writes a byte to the pipe to wake it.
+    '''
+    def __init__(self):
+        self.log = logging.getLogger()
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stopevent = threading.Event()
+        self.lock = threading.Lock()
+
+        (self.wakeup_r, self.wakeup_w) = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        # deadline the scheduler is sleeping until (float('inf') for no
+        # deadline), or None while it is awake.
+        self.sleeping_until = None
+
+        # number of times the scheduler woke up.
+        self.wakeups = 0
+
+        self.tasksets = []
+
+        # heap of (deadline, sequence, taskset). Entries are invalidated
+        # lazily: only the one whose sequence is in self.pending is live.
+        self.heap    = []
+        self.pending = {}
+        self.counter = itertools.count()
+
+    def add(self, taskset):
+        '''
+        Registers a taskset. Its first cycle is due immediately.
+        '''
+        self.tasksets.append(taskset)
+        self.schedule(taskset, time.time())
+
+    def schedule(self, taskset, when):
+        '''
+        Sets the next run of taskset at epoch time when, replacing any
+        deadline previously pending for it.
+        '''
+        with self.lock:
+            self._schedule_locked(taskset, when)
+
+    def _schedule_locked(self, taskset, when):
+        seq = self.counter.next()
+        self.pending[taskset] = (when, seq)
+        heapq.heappush(self.heap, (when, seq, taskset))
+        if self.sleeping_until is not None and when < self.sleeping_until:
+            self.sleeping_until = when
+            self._interrupt()
+
+    def _interrupt(self):
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def trigger(self, taskset, when = None):
+        '''
+        Requests a run of taskset at when (default: now). A deadline already
+        pending earlier than when is kept.
+        '''
+        if when is None:
+            when = time.time()
+
+        with self.lock:
+            current = self.pending.get(taskset, None)
+            if current and current[0] <= when:
+                return
+            self._schedule_locked(taskset, when)
+
+    def next_deadline(self, taskset):
+        with self.lock:
+            current = self.pending.get(taskset, None)
+            if current:
+                return current[0]
+            return None
+
+    def run(self):
+        self.log.debug("Scheduler running with %d tasksets" % len(self.tasksets))
+        while not self.stopevent.isSet():
+            with self.lock:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    (when, seq, taskset) = heapq.heappop(self.heap)
+                    if self.pending.get(taskset, (None, None))[1] == seq:
+                        del self.pending[taskset]
+                        taskset.wake(when)
+
+                timeout = None
+                self.sleeping_until = float('inf')
+                if self.heap:
+                    timeout = self.heap[0][0] - now
+                    self.sleeping_until = self.heap[0][0]
+
+            try:
+                select.select([self.wakeup_r], [], [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+            with self.lock:
+                self.sleeping_until = None
+                self.wakeups += 1
+                self._drain()
+        self.log.debug("Scheduler stopped.")
+
+    def _drain(self):
+        try:
+            while os.read(self.wakeup_r, 512):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def shutdown(self, timeout = None):
+        '''
+        Stops the scheduler and all of its tasksets. Waits at most timeout
+        seconds overall for the taskset threads to finish their current cycle.
+        '''
+        with self.lock:
+            self.stopevent.set()
+            self._interrupt()
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        for ts in self.tasksets:
+            ts.stop()
+
+        for ts in self.tasksets:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+            ts.join(remaining)
+            if ts.isAlive():
+                self.log.warning("Taskset %s did not stop within %s seconds." % (ts.section, timeout))
+
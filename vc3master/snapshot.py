@@ -0,0 +1,97 @@
+#
+# Shared, versioned listing of requests for all task plugins.
+#
+
+import copy
+import logging
+import threading
+import time
+
+
+class RequestSnapshot(object):
+    '''
+    The result of one listRequests() call. It never hands out the requests
+    it holds, only copies of them, so that a consumer modifying its requests
+    does not change what the others see.
+    '''
+    def __init__(self, version, timestamp, requests):
+        self._version   = version
+        self._timestamp = timestamp
+        self._requests  = tuple(requests)
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    def age(self):
+        return time.time() - self._timestamp
+
+    def __len__(self):
+        return len(self._requests)
+
+    def requests(self):
+        return [copy.deepcopy(r) for r in self._requests]
+
+
+class RequestSnapshotService(object):
+    '''
+    Owned by VC3Master. Lists the requests from the infoservice at most once
+    per max_age seconds and publishes the result as a RequestSnapshot shared
+    by all plugins. A write to any request expires the current snapshot.
+    '''
+    def __init__(self, client, metrics, max_age):
+        self.log      = logging.getLogger()
+        self.client   = client
+        self.max_age  = max_age
+        self.lock     = threading.Lock()
+        self.snapshot = None
+        self.expired  = True
+        self.version  = 0
+
+        self.m_refreshes = metrics.counter('vc3_request_snapshot_refreshes_total', 'Request listings fetched from the infoservice.')
+        self.m_reused    = metrics.counter('vc3_request_snapshot_reused_total', 'Request listings served from the shared snapshot.')
+        self.m_size      = metrics.gauge('vc3_request_snapshot_requests', 'Number of requests in the current snapshot.')
+
+    def current(self, max_age = None):
+        '''
+        Returns the current snapshot, refreshing it first if it is expired or
+        older than max_age seconds (default: the service max_age). Raises
+        InfoConnectionFailure if a needed refresh fails.
+        '''
+        if max_age is None:
+            max_age = self.max_age
+
+        with self.lock:
+            if self.expired or self.snapshot is None or self.snapshot.age() > max_age:
+                self._refresh()
+            else:
+                self.m_reused.inc()
+            return self.snapshot
+
+    def expire(self, kind = None, name = None):
+        '''
+        Marks the snapshot as stale. Registered as a listener of the client
+        cache, so it is called on every store/delete.
+        '''
+        if kind is None or kind == 'request':
+            self.expired = True
+
+    def _refresh(self):
+        # cleared before listing, so that a write racing with the listing
+        # expires the new snapshot.
+        self.expired = False
+        try:
+            requests = self.client.listRequests() or []
+        except Exception:
+            self.expired = True
+            raise
+        self.version += 1
+        self.snapshot = RequestSnapshot(self.version, time.time(), requests)
+        self.m_refreshes.inc()
+        self.m_size.set(len(self.snapshot))
+        self.log.debug("Published request snapshot version %d with %d requests." % (self.version, len(self.snapshot)))
+
@@ -0,0 +1,150 @@
+#
+# Pool of persistent, multiplexed ssh connections (ssh ControlMaster).
+#
+
+import errno
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+import time
+
+
+class SSHControlPool(object):
+    '''
+    Gives the ssh options that make every connection to the same (host,
+    port, user, key) share one master connection, so that repeated checks
+    only open a new channel instead of doing a full handshake.
+
+    The master sockets live in control_dir. ssh itself closes a master after
+    persist seconds without use; the pool forgets about it then, and closes
+    the master of a connection that failed, so that the next attempt starts
+    from a fresh handshake.
+
+    With control_dir None the pool is disabled and options() is empty.
+    '''
+    def __init__(self, metrics, control_dir = None, persist = 300):
+        self.log         = logging.getLogger()
+        self.control_dir = control_dir
+        self.persist     = persist
+        self.lock        = threading.Lock()
+        self.connections = {}
+        self.last_evict  = time.time()
+
+        if self.control_dir:
+            self.control_dir = os.path.expanduser(self.control_dir)
+            try:
+                os.makedirs(self.control_dir, 0700)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self.log.debug("ssh control sockets at %s" % self.control_dir)
+
+        self.m_open     = metrics.gauge('vc3_ssh_control_connections', 'ssh master connections believed open.')
+        self.m_reused   = metrics.counter('vc3_ssh_control_reused_total', 'ssh commands that reused an open master connection.')
+        self.m_new      = metrics.counter('vc3_ssh_control_new_total', 'ssh commands that had to open a master connection.')
+        self.m_failures = metrics.counter('vc3_ssh_control_failures_total', 'ssh commands that failed through the pool.')
+
+    def _key(self, host, port, user, key_id):
+        return (host, str(port), user, key_id)
+
+    def control_path(self, host, port, user, key_id):
+        # sockets paths are limited to ~100 characters, so we use a digest.
+        digest = hashlib.sha1(repr(self._key(host, port, user, key_id))).hexdigest()[:20]
+        return os.path.join(self.control_dir, digest)
+
+    def is_active(self, host, port, user, key_id):
+        if not self.control_dir:
+            return False
+        return os.path.exists(self.control_path(host, port, user, key_id))
+
+    def options(self, host, port, user, key_id):
+        '''
+        Options to add to the ssh command line of a connection to host:port
+        as user, authenticating with the key identified by key_id.
+        '''
+        if not self.control_dir:
+            return []
+
+        self.evict_idle()
+
+        key  = self._key(host, port, user, key_id)
+        path = self.control_path(host, port, user, key_id)
+
+        if os.path.exists(path):
+            self.m_reused.inc()
+        else:
+            self.m_new.inc()
+
+        with self.lock:
+            conn = self.connections.setdefault(key, { 'path' : path, 'failures' : 0 })
+            conn['last_used'] = time.time()
+            self.m_open.set(len(self.connections))
+
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % path,
+                '-o', 'ControlPersist=%d' % self.persist]
+
+    def report(self, host, port, user, key_id, ok):
+        '''
+        Records the result of a command that used options(). A failure
+        closes the master, since a broken master would fail every command
+        multiplexed through it.
+        '''
+        if not self.control_dir:
+            return
+
+        key = self._key(host, port, user, key_id)
+        with self.lock:
+            conn = self.connections.get(key, None)
+            if conn is None:
+                return
+            if ok:
+                conn['failures'] = 0
+                return
+            conn['failures'] += 1
+            self.m_failures.inc()
+            self.connections.pop(key, None)
+            self.m_open.set(len(self.connections))
+        self._close(host, conn['path'])
+
+    def evict_idle(self):
+        '''
+        Forgets connections unused for longer than persist seconds (their
+        masters have exited by then), and removes their stale sockets.
+        '''
+        now = time.time()
+        if now - self.last_evict < 60:
+            return
+        self.last_evict = now
+
+        with self.lock:
+            idle = [(k, c) for (k, c) in self.connections.items() if now - c['last_used'] > self.persist]
+            for (key, conn) in idle:
+                self.connections.pop(key, None)
+            self.m_open.set(len(self.connections))
+
+        for (key, conn) in idle:
+            self._close(key[0], conn['path'])
+
+    def close_all(self):
+        if not self.control_dir:
+            return
+        with self.lock:
+            conns = self.connections.items()
+            self.connections = {}
+            self.m_open.set(0)
+        for (key, conn) in conns:
+            self._close(key[0], conn['path'])
+
+    def _close(self, host, path):
+        if not os.path.exists(path):
+            return
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['ssh', '-o', 'ControlPath=%s' % path, '-O', 'exit', host], stdout = devnull, stderr = devnull)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
@@ -0,0 +1,129 @@
+#
+# Job counts of requests, aggregated from the statusraw of the factories.
+#
+
+import threading
+
+from array import array
+
+
+STATES = ('running', 'idle', 'error')
+
+
+class StatusTable(object):
+    '''
+    Keeps the (running, idle, error) counts reported by the factories for
+    every (request, nodeset, allocation, factory) cell in one array of
+    longs, three slots per cell, together with running totals per nodeset
+    and per request.
+
+    update() reads only the aggregated counts of the nodesets asked for,
+    not the rest of statusraw, and only writes the cells whose counts
+    changed, applying the difference to the totals, so that
+    nodeset_totals() and request_totals() are O(1).
+    '''
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.counts   = array('l')
+        self.free     = []
+        self.cells    = {}
+        self.nodesets = {}
+        self.totals   = {}
+
+    def update(self, request_name, statusraw, nodeset_names):
+        '''
+        Sets the counts of request_name from statusraw, which is
+        statusraw[factory][nodeset][allocation]['aggregated'][state]. Only
+        the nodesets in nodeset_names are counted. Returns False if nothing
+        changed.
+        '''
+        current = self.read(statusraw, set(nodeset_names))
+        with self.lock:
+            cells   = self.cells.setdefault(request_name, {})
+            changed = False
+
+            for key in cells.keys():
+                if not current.has_key(key):
+                    changed = self._set(request_name, key, (0, 0, 0)) or changed
+                    self.free.append(cells.pop(key))
+
+            for (key, values) in current.items():
+                changed = self._set(request_name, key, values) or changed
+
+            return changed
+
+    def read(self, statusraw, nodeset_names):
+        '''
+        (nodeset, allocation, factory) -> (running, idle, error). Missing or
+        malformed entries are not counted.
+        '''
+        current = {}
+        for (factory, by_nodeset) in statusraw.items():
+            for nodeset in nodeset_names:
+                try:
+                    by_allocation = by_nodeset[nodeset].items()
+                except (KeyError, TypeError, AttributeError):
+                    continue
+                for (allocation, status) in by_allocation:
+                    try:
+                        aggregated = status['aggregated']
+                        current[(nodeset, allocation, factory)] = tuple([int(aggregated.get(state, 0)) for state in STATES])
+                    except (KeyError, TypeError, ValueError, AttributeError):
+                        pass
+        return current
+
+    def _set(self, request_name, key, values):
+        cells = self.cells[request_name]
+        row   = cells.get(key, None)
+        if row is None:
+            if not any(values):
+                return False
+            if self.free:
+                row = self.free.pop()
+            else:
+                row = len(self.counts) / len(STATES)
+                self.counts.extend((0, 0, 0))
+            cells[key] = row
+
+        base = row * len(STATES)
+        nodeset_totals = self.nodesets.setdefault(request_name, {}).setdefault(key[0], array('l', (0, 0, 0)))
+        request_totals = self.totals.setdefault(request_name, array('l', (0, 0, 0)))
+        changed = False
+        for i in range(len(STATES)):
+            delta = values[i] - self.counts[base + i]
+            if delta:
+                self.counts[base + i] = values[i]
+                nodeset_totals[i]    += delta
+                request_totals[i]    += delta
+                changed = True
+        return changed
+
+    def nodeset_totals(self, request_name, nodeset_name):
+        '''
+        state -> count for one nodeset of request_name.
+        '''
+        with self.lock:
+            totals = self.nodesets.get(request_name, {}).get(nodeset_name, (0, 0, 0))
+            return dict(zip(STATES, totals))
+
+    def request_totals(self, request_name):
+        '''
+        state -> count over the nodesets of request_name.
+        '''
+        with self.lock:
+            totals = self.totals.get(request_name, (0, 0, 0))
+            return dict(zip(STATES, totals))
+
+    def remove(self, request_name):
+        with self.lock:
+            for row in self.cells.pop(request_name, {}).values():
+                base = row * len(STATES)
+                for i in range(len(STATES)):
+                    self.counts[base + i] = 0
+                self.free.append(row)
+            self.nodesets.pop(request_name, None)
+            self.totals.pop(request_name, None)
+
+    def keys(self):
+        with self.lock:
+            return self.cells.keys()
@@ -4,7 +4,6 @@
 
 import logging
 import threading
-import datetime
 import traceback
 import time
 
@@ -21,13 +20,28 @@ class VC3TaskSet(threading.Thread):
         '''
         self.log = logging.getLogger()
         threading.Thread.__init__(self) # init the thread
+        self.daemon = True
         self.stopevent = threading.Event()
-        self.thread_loop_interval = 1
+        self.runevent = threading.Event()
         self.parent = parent
+        self.scheduler = parent.scheduler
         self.config = config
         self.section = section
         self.polling_interval = int(self.config.get(self.section, 'polling_interval')) 
-        self.client = parent.client
+        self.client = parent.clientcache.scope(section)
+        self.metrics = parent.metrics
+
+        # deadline of the cycle the scheduler last woke us for
+        self.due = None
+
+        self.m_runtime = self.metrics.histogram('vc3_task_runtime_seconds', 'Duration of runtask() per plugin.')
+        self.m_success = self.metrics.gauge('vc3_task_last_success_timestamp_seconds', 'Time of the last runtask() that did not raise.')
+        self.m_errors  = self.metrics.counter('vc3_task_exceptions_total', 'Exceptions raised by runtask().')
+        self.m_overrun = self.metrics.counter('vc3_task_overruns_total', 'Times runtask() took longer than polling_interval.')
+        self.m_entities = self.metrics.gauge('vc3_task_entities_processed', 'Entities processed by the plugin in its last cycle.')
+        self.m_cycle   = self.metrics.histogram('vc3_taskset_cycle_seconds', 'Duration of a full taskset cycle.')
+        self.m_lag     = self.metrics.gauge('vc3_taskset_cycle_lag_seconds', 'Delay between the scheduled and actual start of the last cycle.')
+        self.m_cycle_overrun = self.metrics.counter('vc3_taskset_overruns_total', 'Cycles that took longer than polling_interval.')
 
         pil = self.config.get(self.section, 'taskplugins').split(',')
         self.pluginstrs=[]
@@ -42,34 +56,100 @@ class VC3TaskSet(threading.Thread):
                              config=self.config,
                              section=self.section)
             self.tasks.append(p)
+
+        # entity kinds listed in bulk at the start of every cycle.
+        self.prefetch = []
+        for p in self.tasks:
+            for kind in p.prefetch:
+                if kind not in self.prefetch:
+                    self.prefetch.append(kind)
         self.log.debug("Task plugins initialized.")
 
 
     def run(self):
         '''
+        Waits until the scheduler wakes this taskset, runs all of its plugins
+        and asks the scheduler for the next deadline.
         '''
         self.log.debug("Running Taskset %s" % self.section)
-        tdinterval = datetime.timedelta(seconds = self.polling_interval)
-        lastrun = datetime.datetime(2000, 12, 1)
-        while not self.stopevent.isSet():
-            #self.log.debug("Checking interval...")
-            if datetime.datetime.now() - lastrun > tdinterval:
-                for p in self.tasks:
-                    try:            
-                        p.runtask()
-                    except Exception, e:
-                        self.log.warning("Exception during runtask(): %s " % traceback.format_exc(None))
-                lastrun = datetime.datetime.now()
-                self.log.debug("Waiting for %s seconds..." % self.polling_interval)    
-            time.sleep(self.thread_loop_interval)
+        while True:
+            self.runevent.wait()
+            self.runevent.clear()
+            if self.stopevent.isSet():
+                break
 
+            start = time.time()
+            if self.due is not None:
+                self.m_lag.set(max(start - self.due, 0), taskset = self.section)
 
-    def join(self,timeout=None):
+            self.client.begin_cycle()
+            self.client.prefetch(self.prefetch)
+            for p in self.tasks:
+                if self.stopevent.isSet():
+                    break
+                self.runplugin(p)
+            self.client.end_cycle()
+
+            elapsed = time.time() - start
+            self.m_cycle.observe(elapsed, taskset = self.section)
+            if elapsed > self.polling_interval:
+                self.m_cycle_overrun.inc(taskset = self.section)
+                self.log.warning("Taskset %s cycle took %.1f seconds, longer than its polling_interval of %d seconds." % (self.section, elapsed, self.polling_interval))
+
+            # a plugin may have asked for an earlier run during this cycle.
+            self.scheduler.trigger(self, start + self.polling_interval)
+            self.log.debug("Waiting for %s seconds..." % self.polling_interval)    
+
+        for p in self.tasks:
+            try:
+                p.stop()
+            except Exception, e:
+                self.log.warning("Could not stop plugin %s (%s)", p.__class__.__name__, e)
+        self.log.debug("Taskset %s stopped." % self.section)
+
+    def runplugin(self, p):
+        labels = { 'taskset' : self.section, 'plugin' : p.__class__.__name__ }
+
+        p.processed = None
+        start = time.time()
+        try:            
+            p.runtask()
+            self.m_success.set(time.time(), **labels)
+        except Exception, e:
+            self.m_errors.inc(**labels)
+            self.log.warning("Exception during runtask(): %s " % traceback.format_exc(None))
+
+        elapsed = time.time() - start
+        self.m_runtime.observe(elapsed, **labels)
+        if elapsed > self.polling_interval:
+            self.m_overrun.inc(**labels)
+        if p.processed is not None:
+            self.m_entities.set(p.processed, **labels)
+
+    def wake(self, when = None):
+        '''
+        Called by the scheduler when the next cycle, due at when, should run.
+        '''
+        self.due = when
+        self.runevent.set()
+
+    def trigger(self, when = None):
+        '''
+        Run a cycle of this taskset at when (default: as soon as possible).
+        '''
+        self.scheduler.trigger(self, when)
+
+    def stop(self):
         if not self.stopevent.isSet():
-            self.log.debug('joining thread')
+            self.log.debug('stopping taskset %s' % self.section)
             self.stopevent.set()
-            #self._join()
-            #threading.Thread.join(self, timeout)
+        self.runevent.set()
+
+    def join(self,timeout=None):
+        self.stop()
+        if self.isAlive():
+            self.log.debug('joining thread')
+            threading.Thread.join(self, timeout)
 
 
 
@@ -77,13 +157,28 @@ class VC3Task(object):
     '''
     
     '''
+    # Kinds of entities (e.g., 'Nodeset') the taskset should list in bulk at
+    # the start of every cycle, so that lookups by name are served from memory.
+    prefetch = []
+
     def __init__(self, parent, config, section):
         self.log = logging.getLogger()    
         self.parent = parent
         self.config = config
         self.section = section    
+        self.metrics = parent.metrics
+
+        # set by runtask() to the number of entities handled in the cycle.
+        self.processed = None
                 
     def runtask(self):
         '''
         '''
         raise NotImplementedError
+
+    def stop(self):
+        '''
+        Called from the taskset thread when the taskset stops, to end any
+        threads the plugin started.
+        '''
+        pass
@@ -0,0 +1,105 @@
+#
+# Change tracking for infoservice entities, so that only modified entities
+# are written back.
+#
+
+import copy
+import logging
+import threading
+
+
+def entity_fields(entity):
+    '''
+    Returns a dictionary with the values of the infoservice attributes of
+    entity.
+    '''
+    attributes = getattr(entity, 'infoattributes', None)
+    if attributes is None:
+        attributes = [a for a in vars(entity).keys() if not a.startswith('_')]
+    return dict([(a, getattr(entity, a, None)) for a in attributes])
+
+
+class ChangeTracker(object):
+    '''
+    Snapshots the fields of entities when they are loaded. store() writes an
+    entity through store<Kind>() only when some field differs from its
+    snapshot, and commit() does the same for all tracked entities.
+    '''
+    def __init__(self, client, metrics, name):
+        self.log       = logging.getLogger()
+        self.client    = client
+        self.name      = name
+        self.lock      = threading.Lock()
+        self.snapshots = {}
+
+        self.m_writes  = metrics.counter('vc3_entity_writes_total', 'Entities written to the infoservice.')
+        self.m_avoided = metrics.counter('vc3_entity_writes_avoided_total', 'Entity writes skipped because no field changed.')
+
+    def _key(self, entity):
+        return (entity.__class__.__name__, entity.name)
+
+    def track(self, entity, new = False):
+        '''
+        Remembers the current fields of entity. A new entity has never been
+        stored, and is always considered modified.
+        '''
+        snapshot = None
+        if not new:
+            snapshot = copy.deepcopy(entity_fields(entity))
+        with self.lock:
+            self.snapshots[self._key(entity)] = (entity, snapshot)
+
+    def forget(self, entity):
+        with self.lock:
+            self.snapshots.pop(self._key(entity), None)
+
+    def clear(self):
+        with self.lock:
+            self.snapshots = {}
+
+    def changed_fields(self, entity):
+        current = entity_fields(entity)
+        with self.lock:
+            (tracked, snapshot) = self.snapshots.get(self._key(entity), (None, None))
+        if snapshot is None:
+            return sorted(current.keys())
+        return [f for f in sorted(current.keys()) if current[f] != snapshot.get(f, None)]
+
+    def is_dirty(self, entity):
+        return len(self.changed_fields(entity)) > 0
+
+    def store(self, entity):
+        '''
+        Stores entity if it was modified since it was tracked. Returns True
+        if the entity was written.
+        '''
+        kind    = entity.__class__.__name__
+        changed = self.changed_fields(entity)
+
+        if not changed:
+            self.m_avoided.inc(plugin = self.name, kind = kind)
+            return False
+
+        self.log.debug("Storing %s '%s' (changed: %s)", kind, entity.name, ', '.join(changed))
+        getattr(self.client, 'store' + kind)(entity)
+        self.m_writes.inc(plugin = self.name, kind = kind)
+        self.track(entity)
+        return True
+
+    def commit(self):
+        '''
+        Stores all modified tracked entities. Returns the number of entities
+        written.
+        '''
+        with self.lock:
+            entities = [entity for (entity, snapshot) in self.snapshots.values()]
+
+        written = 0
+        for entity in entities:
+            try:
+                if self.store(entity):
+                    written += 1
+            except Exception, e:
+                self.log.warning("Storing %s '%s' failed. (%s)", entity.__class__.__name__, entity.name, e)
+        return written
+
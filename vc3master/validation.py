@@ -0,0 +1,151 @@
+#
+# Concurrent, cached login checks of allocations.
+#
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from base64 import b64decode
+from multiprocessing.pool import ThreadPool
+
+from vc3master.probe import run_with_deadline
+
+
+class LoginCheck(object):
+    '''
+    A login into accesshost:accessport as accountname, using token (the
+    base64 private key or proxy of the allocation) with accessmethod.
+    '''
+    def __init__(self, name, accessmethod, accesshost, accessport, accountname, token):
+        self.name         = name
+        self.accessmethod = accessmethod
+        self.accesshost   = accesshost
+        self.accessport   = str(accessport)
+        self.accountname  = accountname
+        self.token        = token
+        self.key_id       = hashlib.sha1(token or '').hexdigest()
+
+    def cache_key(self):
+        return (self.accessmethod, self.accesshost, self.accessport, self.accountname, self.key_id)
+
+
+class LoginValidator(object):
+    '''
+    Runs LoginChecks, at most max_concurrency at a time and at most per_host
+    at a time against the same host, killing each after deadline seconds.
+
+    A result is (ok, message). Successful results are reused for ttl
+    seconds, and failures for failure_ttl seconds, for checks with the same
+    host, port, account and key.
+    '''
+    def __init__(self, metrics, max_concurrency = 8, per_host = 2, deadline = 30, ttl = 300, failure_ttl = 30, sshpool = None):
+        self.log         = logging.getLogger()
+        self.per_host    = per_host
+        self.deadline    = deadline
+        self.ttl         = ttl
+        self.failure_ttl = failure_ttl
+        self.sshpool     = sshpool
+        self.pool        = ThreadPool(max_concurrency)
+        self.lock        = threading.Lock()
+        self.hosts       = {}
+        self.results     = {}
+
+        self.m_checks   = metrics.counter('vc3_allocation_validations_total', 'Allocation login checks, by result (ok, failed, cached).')
+        self.m_duration = metrics.histogram('vc3_allocation_validation_seconds', 'Duration of allocation login checks.')
+
+    def validate_all(self, checks):
+        '''
+        Runs all checks concurrently. Returns name -> result.
+        '''
+        if not checks:
+            return {}
+        start   = time.time()
+        results = self.pool.map(self.validate, checks)
+        self.log.debug("Validated %d allocations in %.1f seconds." % (len(checks), time.time() - start))
+        return dict(zip([c.name for c in checks], results))
+
+    def validate(self, check):
+        key = check.cache_key()
+        with self.lock:
+            cached = self.results.get(key, None)
+            if cached and cached[0] > time.time():
+                self.m_checks.inc(result = 'cached')
+                return cached[1]
+            semaphore = self.hosts.setdefault(check.accesshost, threading.Semaphore(self.per_host))
+
+        with semaphore:
+            start  = time.time()
+            result = self.run(check)
+            self.m_duration.observe(time.time() - start)
+
+        ttl = result[0] and self.ttl or self.failure_ttl
+        with self.lock:
+            self.results[key] = (time.time() + ttl, result)
+            self.expire()
+        self.m_checks.inc(result = result[0] and 'ok' or 'failed')
+        return result
+
+    def expire(self):
+        now = time.time()
+        for (key, (until, result)) in self.results.items():
+            if until <= now:
+                self.results.pop(key, None)
+
+    def run(self, check):
+        (fd, path) = tempfile.mkstemp()
+        try:
+            os.write(fd, b64decode(check.token))
+            os.close(fd)
+            os.chmod(path, 0400)
+
+            if check.accessmethod in ('ssh', 'sshproxy'):
+                returncode = self.run_ssh(check, path)
+            elif check.accessmethod == 'gsissh':
+                returncode = run_with_deadline(self.gsissh_command(check), self.deadline, env = { 'X509_USER_PROXY' : path })
+            else:
+                return (False, 'Can only validate ssh, gsissh accessmethods.')
+        except Exception, e:
+            self.log.warning("Could not validate allocation %s (%s)", check.name, e)
+            return (False, 'There was an internal error: %s' % e)
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+        if returncode is None:
+            return (False, 'Login into %s timed out after %d seconds.' % (check.accesshost, self.deadline))
+        if returncode != 0:
+            return (False, 'Could not login into %s (exit status %d).' % (check.accesshost, returncode))
+        return (True, None)
+
+    def run_ssh(self, check, keyfile):
+        mux = []
+        if self.sshpool:
+            mux = self.sshpool.options(check.accesshost, check.accessport, check.accountname, check.key_id)
+
+        returncode = run_with_deadline(['ssh'] + mux + [
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'BatchMode=yes',
+            '-o', 'ConnectTimeout=10',
+            '-i', keyfile,
+            '-l', check.accountname,
+            '-p', check.accessport,
+            check.accesshost, '--', '/bin/date'], self.deadline)
+
+        if self.sshpool:
+            self.sshpool.report(check.accesshost, check.accessport, check.accountname, check.key_id, returncode == 0)
+        return returncode
+
+    def gsissh_command(self, check):
+        return ['gsissh',
+                '-o', 'UserKnownHostsFile=/dev/null',
+                '-o', 'StrictHostKeyChecking=no',
+                '-o', 'ConnectTimeout=10',
+                '-p', check.accessport,
+                check.accesshost, '--', '/bin/date']
@@ -0,0 +1,209 @@
+#
+# Pool of pre-booted, partly configured headnodes.
+#
+
+import logging
+import re
+import time
+
+
+class WarmPool(object):
+    '''
+    Keeps up to sizes[app_type] VMs booted and configured with the base
+    playbook of their app_type, so that a new request can claim one instead
+    of waiting for a Nova boot and a full playbook run. At most budget VMs
+    are kept in the pool over all app_types.
+
+    Pool VMs are named <prefix>pool-<app_type>-<n>. A claimed VM is renamed
+    to the name of the headnode of the request and leaves the pool. Pool VMs
+    found in Nova at start up are adopted, and configured again.
+
+    boot_args are passed to nova.servers.create. is_alive(host) tells whether
+    a VM accepts ssh logins, and command(app_type, host) gives the (argv,
+    cwd, env) of the base playbook run, which is submitted to runner (a
+    ProvisionExecutor) behind all the runs of requests. maintain() should be
+    called once per cycle, after the inventory is refreshed.
+
+    A VM that does not accept ssh boot_timeout seconds after it was booted
+    (or adopted), or whose base playbook is not done configure_timeout
+    seconds after it was submitted, is deleted so that it does not hold
+    part of the budget.
+    '''
+    def __init__(self, nova, inventory, metrics, runner, sizes, budget, prefix, boot_args, is_alive, command, boot_timeout = 900, configure_timeout = 3600):
+        self.log       = logging.getLogger()
+        self.nova      = nova
+        self.inventory = inventory
+        self.runner    = runner
+        self.sizes     = sizes
+        self.budget    = budget
+        self.prefix    = prefix + 'pool-'
+        self.boot_args = boot_args
+        self.is_alive  = is_alive
+        self.command   = command
+
+        self.boot_timeout      = boot_timeout
+        self.configure_timeout = configure_timeout
+
+        # vm name -> { 'app_type', 'state' (booting, configuring, ready), 'job', 'since', 'configuring' }
+        self.vms     = {}
+        self.counter = 0
+
+        self.name_re = re.compile('^' + re.escape(self.prefix) + r'(.+)-(\d+)$')
+
+        self.m_vms    = metrics.gauge('vc3_warmpool_vms', 'VMs in the warm pool, by app_type and state.')
+        self.m_claims = metrics.counter('vc3_warmpool_claims_total', 'Headnodes asked from the warm pool, by app_type and result.')
+        self.m_ready  = metrics.histogram('vc3_warmpool_ready_seconds', 'Time from boot until a pool VM is ready, by app_type.')
+
+    def maintain(self):
+        '''
+        Advances the VMs of the pool, and boots new ones to refill it.
+        '''
+        if not self.inventory.loaded:
+            return
+
+        self.adopt()
+
+        for (name, vm) in self.vms.items():
+            try:
+                self.advance(name, vm)
+            except Exception, e:
+                self.log.warning("Error with warm pool VM %s (%s)", name, e)
+
+        self.refill()
+        self.report()
+
+    def adopt(self):
+        for name in self.inventory.names(self.prefix):
+            m = self.name_re.match(name)
+            if m is None:
+                continue
+            self.counter = max(self.counter, int(m.group(2)) + 1)
+            if not self.vms.has_key(name):
+                self.log.info("Adopting warm pool VM %s", name)
+                self.vms[name] = { 'app_type' : m.group(1), 'state' : 'booting', 'job' : None, 'since' : time.time() }
+
+    def advance(self, name, vm):
+        status = self.inventory.status(name)
+        if status is None:
+            self.log.info("Warm pool VM %s is gone.", name)
+            self.vms.pop(name, None)
+            return
+
+        if status == 'ERROR':
+            self.discard(name, 'it is in ERROR state')
+            return
+
+        if vm['state'] == 'booting':
+            if status == 'ACTIVE':
+                host = self.inventory.ipv4(name)
+                if host and self.is_alive(host):
+                    self.log.debug("Configuring warm pool VM %s at %s", name, host)
+                    (argv, cwd, env) = self.command(vm['app_type'], host)
+                    vm['job']         = self.runner.submit(name, float('inf'), argv, cwd, env)
+                    vm['state']       = 'configuring'
+                    vm['configuring'] = time.time()
+                    return
+            if time.time() - vm['since'] > self.boot_timeout:
+                self.discard(name, 'it did not accept ssh logins within %d seconds' % self.boot_timeout)
+
+        elif vm['state'] == 'configuring':
+            if self.runner.job(name) is not vm['job']:
+                self.discard(name, 'its base playbook run is gone')
+                return
+            if vm['job'].returncode is None and time.time() - vm['configuring'] > self.configure_timeout:
+                self.discard(name, 'its base playbook did not finish within %d seconds' % self.configure_timeout)
+                return
+            returncode = vm['job'].returncode
+            if returncode is None:
+                return
+            vm['job'] = None
+            self.runner.pop(name)
+            if returncode != 0:
+                self.discard(name, 'its base playbook failed with status %d' % returncode)
+                return
+            vm['state'] = 'ready'
+            self.m_ready.observe(time.time() - vm['since'], app_type = vm['app_type'])
+            self.log.info("Warm pool VM %s is ready.", name)
+
+    def refill(self):
+        for (app_type, size) in self.sizes.items():
+            have = len([vm for vm in self.vms.values() if vm['app_type'] == app_type])
+            while have < size and len(self.vms) < self.budget:
+                self.boot(app_type)
+                have += 1
+
+    def boot(self, app_type):
+        name = '%s%s-%d' % (self.prefix, app_type, self.counter)
+        self.counter += 1
+
+        self.log.info("Booting warm pool VM %s", name)
+        try:
+            server = self.nova.servers.create(name = name, **self.boot_args)
+        except Exception, e:
+            self.log.warning("Could not boot warm pool VM %s (%s)", name, e)
+            return
+        self.inventory.add(server)
+        self.vms[name] = { 'app_type' : app_type, 'state' : 'booting', 'job' : None, 'since' : time.time() }
+
+    def discard(self, name, why):
+        self.log.warning("Deleting warm pool VM %s, %s.", name, why)
+        vm = self.vms.pop(name, None)
+        if vm and vm['job'] is not None:
+            self.runner.cancel(name)
+        server = self.inventory.find(name)
+        self.inventory.remove(name)
+        if server is not None:
+            try:
+                server.delete()
+            except Exception, e:
+                self.log.warning("Could not delete warm pool VM %s (%s)", name, e)
+
+    def claim(self, app_type, new_name):
+        '''
+        Renames a ready VM of app_type to new_name and returns its server, or
+        None if there is none ready. The pool is refilled by maintain().
+        '''
+        ready = sorted([name for (name, vm) in self.vms.items() if vm['app_type'] == app_type and vm['state'] == 'ready'])
+        for name in ready:
+            server = self.inventory.find(name)
+            self.vms.pop(name, None)
+            if server is None:
+                continue
+            try:
+                self.nova.servers.update(server, name = new_name)
+            except Exception, e:
+                self.log.warning("Could not rename warm pool VM %s to %s (%s)", name, new_name, e)
+                self.discard(name, 'it could not be renamed')
+                continue
+            self.inventory.rename(name, new_name)
+            self.log.info("Claimed warm pool VM %s as %s", name, new_name)
+            self.m_claims.inc(app_type = app_type, result = 'hit')
+            return server
+
+        self.m_claims.inc(app_type = app_type, result = 'miss')
+        return None
+
+    def report(self):
+        counts = {}
+        for app_type in self.sizes.keys():
+            for state in ['booting', 'configuring', 'ready']:
+                counts[(app_type, state)] = 0
+        for vm in self.vms.values():
+            key = (vm['app_type'], vm['state'])
+            counts[key] = counts.get(key, 0) + 1
+        for ((app_type, state), n) in counts.items():
+            self.m_vms.set(n, app_type = app_type, state = state)
+
+
+def parse_sizes(value):
+    '''
+    Parses 'app_type:n, app_type:n' into a dictionary.
+    '''
+    sizes = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        (app_type, n) = item.split(':')
+        sizes[app_type.strip()] = int(n)
+    return sizes